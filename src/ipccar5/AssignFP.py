@@ -1,38 +1,195 @@
 import numpy as np
-from scipy import interpolate as interp
+from scipy import sparse
 
 from ipccar5.ReadFingerprint import ReadFingerprint as readfp
+from ipccar5 import filecache
 
 """ AssignFP.py
 
 Assigns interpolated fingerprint coefficients to sites identified by the vectors
 of lats and lons provided.
 
+The interpolation is bilinear on the fingerprint grid (sites outside the grid take
+the value at the nearest grid edge), as with a first-order RectBivariateSpline.
+For a set of sites it is a sparse (sites x gridpoints) weight matrix with four
+entries per site. The matrix is built once per location set and grid and reused
+for every fingerprint file on that grid, so localizing a field is a single sparse
+product.
+
 Parameters:
 fp_filename = Fingerprint file passed to ReadFingerprint
 qlats = Vector of latitudes of sites of interest [-90, 90]
 qlons = Vector of longitudes of sites of interest [-180, 180]
+cache_dir = Optional directory of the persistent fingerprint cache. Interpolated
+            fingerprints are stored there keyed by the contents of the fingerprint
+            file and the site coordinates, so repeat calls skip reading and
+            interpolating the file.
+cache_max_bytes = Size bound of the fingerprint entries of the cache directory.
+                  Least recently used entries are evicted once it is exceeded.
 
 Return:
 fp_sites = Vector of fingerprint coefficients for the sites of interest
 
+AssignFPs() takes a list of fingerprint files instead and returns an array of
+fingerprint coefficients [files, sites]. InterpolateFields() does the same for a
+stack of fingerprint fields already in memory.
 
 """
 
+# Default size bound of the fingerprint cache (1 GiB)
+CACHE_MAX_BYTES = 1 << 30
+
+# Prefix of the keys of the fingerprint cache entries
+CACHE_PREFIX = "fprint-"
+
+# Weight matrices most recently built in this process, keyed by grid and sites
+_weights_memo = {}
+WEIGHTS_MEMO_SIZE = 4
+
+
+def AssignFP(
+    fp_filename, qlats, qlons, cache_dir=None, cache_max_bytes=CACHE_MAX_BYTES
+):
+    return AssignFPs(
+        [fp_filename],
+        qlats,
+        qlons,
+        cache_dir=cache_dir,
+        cache_max_bytes=cache_max_bytes,
+    )[0]
+
+
+def AssignFPs(
+    fp_filenames, qlats, qlons, cache_dir=None, cache_max_bytes=CACHE_MAX_BYTES
+):
+    qlats = np.asarray(qlats, dtype=float)
+    qlons = np.asarray(qlons, dtype=float)
+
+    # Each distinct file is read and interpolated only once
+    unique_filenames = list(dict.fromkeys(fp_filenames))
+    fp_sites = {}
+
+    # Look for these sites in the fingerprint cache
+    keys = {}
+    if cache_dir is not None:
+        for fname in unique_filenames:
+            keys[fname] = CACHE_PREFIX + filecache.cache_key(
+                "AssignFP-v1", filecache.file_digest(fname, cache_dir), qlats, qlons
+            )
+            cached = filecache.load_array(cache_dir, keys[fname])
+            if cached is not None:
+                fp_sites[fname] = cached
+
+    # Read the remaining fingerprints and stack those that share a grid
+    grids = {}
+    for fname in unique_filenames:
+        if fname in fp_sites:
+            continue
+        try:
+            (fp, fp_lats, fp_lons) = readfp(fname)
+        except Exception as e:
+            print(f"Cannot open fingerprint file: {e} \n")
+            raise
+        grid_key = filecache.cache_key(
+            np.asarray(fp_lats, dtype=float), np.asarray(fp_lons, dtype=float)
+        )
+        grid = grids.setdefault(grid_key, (fp_lats, fp_lons, [], []))
+        grid[2].append(fname)
+        grid[3].append(np.ma.getdata(fp).ravel())
+
+    # Interpolate all fields on each grid with one sparse product
+    for fp_lats, fp_lons, fnames, fields in grids.values():
+        values = InterpolateFields(fp_lats, fp_lons, np.stack(fields), qlats, qlons)
+        for i, fname in enumerate(fnames):
+            fp_sites[fname] = values[i]
+
+            # Store the interpolated fingerprints for the next run
+            if cache_dir is not None:
+                filecache.save_array(cache_dir, keys[fname], fp_sites[fname])
 
-def AssignFP(fp_filename, qlats, qlons):
-    ## Read in the fitted parameters from parfile
-    # Open the file
-    try:
-        (fp, fp_lats, fp_lons) = readfp(fp_filename)
-    except Exception as e:
-        print(f"Cannot open fingerprint file: {e} \n")
+    if cache_dir is not None and grids:
+        filecache.evict(cache_dir, cache_max_bytes, prefix=CACHE_PREFIX)
 
-    # Interpolate the fingerprint to these locations
+    return np.stack([fp_sites[fname] for fname in fp_filenames])
+
+
+def InterpolateFields(fp_lats, fp_lons, fields, qlats, qlons):
+    # Interpolate a stack of fingerprint fields [fields, lats * lons] (or
+    # [fields, lats, lons]) on one grid to the sites with a single sparse product,
+    # returning the fingerprint coefficients [fields, sites]
+    weights = BilinearWeights(fp_lats, fp_lons, qlats, qlons)
+    fields = np.reshape(fields, (len(fields), -1))
+    return np.ascontiguousarray((weights @ fields.T).T) * 1000
+
+
+def BilinearWeights(fp_lats, fp_lons, qlats, qlons):
+    """
+    Build the sparse bilinear interpolation weights from a fingerprint grid to sites.
+
+    Parameters
+    ----------
+    fp_lats, fp_lons : array-like
+        Latitudes (in any order) and increasing longitudes [0, 360) of the grid.
+    qlats, qlons : array-like
+        Latitudes [-90, 90] and longitudes [-180, 180] of the sites.
+
+    Returns
+    -------
+    scipy.sparse.csr_array
+        Weights of shape (sites, len(fp_lats) * len(fp_lons)), such that
+        ``weights @ fp.ravel()`` interpolates a field ``fp`` of shape
+        (len(fp_lats), len(fp_lons)) to the sites. Sites beyond the grid take the
+        value at the nearest grid edge.
+    """
+    fp_lats = np.asarray(fp_lats, dtype=float)
+    fp_lons = np.asarray(fp_lons, dtype=float)
+    qlats = np.asarray(qlats, dtype=float)
+    qlons = np.mod(np.asarray(qlons, dtype=float), 360)
+
+    memo_key = filecache.cache_key(fp_lats, fp_lons, qlats, qlons)
+    if memo_key in _weights_memo:
+        return _weights_memo[memo_key]
+
+    # Interpolate along the sorted latitudes, but index the grid as stored
     lat_sort = np.argsort(fp_lats)
-    fp_interp = interp.RectBivariateSpline(
-        fp_lats[lat_sort], fp_lons, fp[lat_sort, :], kx=1, ky=1
+    (ilat, wlat) = _axis_weights(fp_lats[lat_sort], qlats)
+    (ilon, wlon) = _axis_weights(fp_lons, qlons)
+    nlon = len(fp_lons)
+
+    rows = np.repeat(np.arange(len(qlats)), 4)
+    cols = np.stack(
+        [
+            lat_sort[ilat] * nlon + ilon,
+            lat_sort[ilat] * nlon + ilon + 1,
+            lat_sort[ilat + 1] * nlon + ilon,
+            lat_sort[ilat + 1] * nlon + ilon + 1,
+        ],
+        axis=1,
+    ).ravel()
+    vals = np.stack(
+        [
+            (1 - wlat) * (1 - wlon),
+            (1 - wlat) * wlon,
+            wlat * (1 - wlon),
+            wlat * wlon,
+        ],
+        axis=1,
+    ).ravel()
+
+    weights = sparse.csr_array(
+        (vals, (rows, cols)), shape=(len(qlats), len(fp_lats) * nlon)
     )
-    fp_sites = fp_interp.ev(qlats, np.mod(qlons, 360)) * 1000
+    if len(_weights_memo) >= WEIGHTS_MEMO_SIZE:
+        del _weights_memo[next(iter(_weights_memo))]
+    _weights_memo[memo_key] = weights
+
+    return weights
+
 
-    return fp_sites
+def _axis_weights(grid, q):
+    # Lower grid index and the fractional distance towards the next grid point for
+    # each query point, clamping query points to the ends of the grid
+    q = np.clip(q, grid[0], grid[-1])
+    idx = np.clip(np.searchsorted(grid, q, side="right") - 1, 0, len(grid) - 2)
+    frac = (q - grid[idx]) / (grid[idx + 1] - grid[idx])
+    return (idx, frac)
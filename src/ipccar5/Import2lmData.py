@@ -1,7 +1,10 @@
 import numpy as np
+import os
 import sys
-import h5py
 import re
+from concurrent.futures import ThreadPoolExecutor
+from ipccar5 import filecache
+from ipccar5.climate_reader import OpenClimate
 
 
 """
@@ -12,8 +15,49 @@ function reads in the hdf5 file and filters the data for the variable, and scena
 of interest.  Additional filtering according to years, reference year(s), etc. will be
 handled in another script.
 
+Only the rows (years) that are needed are read from the file: the reference period
+and the years between year_start and year_end (inclusive, all years by default). They
+are read with one hyperslab selection straight into a preallocated buffer, so neither
+the rest of the record nor a temporary copy of it is ever held in memory. The returned "years" are the years
+between year_start and year_end.
+
+For temperature target scenarios the samples are selected with a peak-temperature
+index: the peak temperature of every sample of every scenario over the target window,
+sorted, together with the scenario and column of the sample. The matching samples are
+found by binary search and only their columns are read, with the scenario groups read
+concurrently, each into its own block of columns of one output array. The index is
+built on first use and, if cache_dir is given, stored there keyed by the contents of
+the climate file and the window years, so later runs for any target and window width
+skip the scan of the ensemble. The least recently used indices are evicted after each
+save until they take at most PEAK_CACHE_MAX_BYTES.
+
+The climate file is opened with the reader for climate_format (see climate_reader.py),
+so HDF5, NetCDF and Zarr climate data with the same layout are all read the same way.
+A climate file opened with OpenClimateFile() is kept open and reused by every later
+call on that file in the same process, instead of being reopened each time.
+
+If dtype is given (e.g. float32), the data is read straight into arrays of that type
+and returned in it; the reference period mean is accumulated in double precision.
+
 """
 
+# Climate files kept open for the life of the process, by real path
+_open_climate_files = {}
+
+# Size bound of the peak-temperature indices in the cache directory (256 MiB)
+PEAK_CACHE_MAX_BYTES = 256 << 20
+
+# Prefix of the keys of the peak-temperature index cache entries
+PEAK_CACHE_PREFIX = "peak-"
+
+
+def OpenClimateFile(climate_fname, climate_format="auto"):
+    # Open a climate file and keep it open for later calls of Import2lmData
+    path = os.path.realpath(climate_fname)
+    if path not in _open_climate_files:
+        _open_climate_files[path] = OpenClimate(path, climate_format)
+    return _open_climate_files[path]
+
 
 def Import2lmData(
     variable="surface_temperature",
@@ -24,95 +68,201 @@ def Import2lmData(
     twinyear_start=2020,
     twinyear_end=2100,
     climate_fname="twolayer_SSPs.h5",
+    year_start=None,
+    year_end=None,
+    cache_dir=None,
+    climate_format="auto",
+    dtype=None,
 ):
-    # Open the SSP hdf5 file
+    # Open the SSP hdf5 file, unless it is kept open already
     # sspfile = os.path.join(directory, climate_fname)
-    hf = h5py.File(climate_fname, "r")
+    (hf, keep_open) = _climate_file(climate_fname, climate_format)
 
     # Do we have a temperature target scenario?
     scenario_test = re.search("^tlim(\d*\.?\d+)win(\d*\.?\d+)$", scenario)
     if scenario_test:
-        # Initialize samps array
-        samps = []
-        temp_samps = []
-
-        # Loop through all available scenarios
-        for this_scenario in hf.keys():
-            # Skip "year" in this_scenario
-            if this_scenario == "year":
-                continue
-
-            # Extract the samples
-            try:
-                these_samps = hf[this_scenario][variable][()]
-                these_temp_samps = hf[this_scenario]["surface_temperature"][()]
-            except Exception:
-                raise ValueError(
-                    "Cannot extract data for this combination: {} - {}.".format(
-                        scenario, variable
-                    )
+        # Gather the datasets of all available scenarios, skipping "year"
+        try:
+            scenarios = [x for x in hf.keys() if x != "year"]
+            dsets = [hf[x][variable] for x in scenarios]
+            temp_dsets = [hf[x]["surface_temperature"] for x in scenarios]
+        except Exception:
+            raise ValueError(
+                "Cannot extract data for this combination: {} - {}.".format(
+                    scenario, variable
                 )
-
-            # Append these samples to the main samps array
-            samps.extend(these_samps.T)
-            temp_samps.extend(these_temp_samps.T)
-
-        # Make samps a numpy array
-        samps = np.array(samps).T
-        temp_samps = np.array(temp_samps).T
-
-        # Get the years from the shape of the samps array
-        years = np.arange(1750, 1750 + samps.shape[0])
+            )
 
     # We have a standard SSP scenario
     else:
         try:
-            samps = hf[scenario][variable][()]
+            dsets = [hf[scenario][variable]]
         except ValueError as e:
             raise ValueError(
                 "Exception: {}. Cannot extract data for this combination: {} - {}".format(
                     e, scenario, variable
                 )
             )
-        years = np.arange(1750, 1750 + samps.shape[0])
 
-    # Calculate the reference period values (mean between refyear_start and refyear_end inclusive)
-    year_idx = np.flatnonzero(
-        np.logical_and(years >= refyear_start, years <= refyear_end)
-    )
-    ref_vals = np.mean(samps[year_idx, :], axis=0)[None, :]
-    samps = samps - ref_vals
+    # Get the years from the shape of the datasets
+    years = np.arange(1750, 1750 + dsets[0].shape[0])
+
+    # Rows of the reference period and of the years of interest
+    ref_rows = _year_rows(years, refyear_start, refyear_end)
+    rows = _year_rows(years, year_start, year_end)
 
-    # If this is a temperature target scenario, filter for the samples within the target window
-    # over the years 2020 - 2100
+    # If this is a temperature target scenario, find the samples within the target window
+    # over the years 2020 - 2100 and read only those
     if scenario_test:
         # Extract the limit from the scenario string
         temp_target = float(scenario_test.group(1))
         temp_target_window = float(scenario_test.group(2))
 
-        # Get the year indices for years 2020 - 2100
-        window_years_idx = np.flatnonzero(
-            np.logical_and(years >= twinyear_start, years <= twinyear_end)
+        # Binary search the peak-temperature index for the samples that match the filter
+        peak_index = _peak_index(
+            climate_fname,
+            temp_dsets,
+            _year_rows(years, twinyear_start, twinyear_end),
+            twinyear_start,
+            twinyear_end,
+            cache_dir,
         )
-
-        # Get the sample indices that match the filter
-        samps_max = np.nanmax(temp_samps[window_years_idx, :], axis=0)
-        match_idx = np.logical_and(
-            samps_max >= temp_target - temp_target_window,
-            samps_max <= temp_target + temp_target_window,
+        lo = np.searchsorted(
+            peak_index["peak"], temp_target - temp_target_window, side="left"
+        )
+        hi = np.searchsorted(
+            peak_index["peak"], temp_target + temp_target_window, side="right"
         )
+        match = peak_index[lo:hi]
 
-        # Subset samps for the samples that match the filter
-        samps = samps[:, match_idx]
+        # Columns of the matching samples in each scenario, in file order
+        cols = [
+            np.sort(match["column"][match["scenario"] == i]) for i in range(len(dsets))
+        ]
+    else:
+        cols = None
+
+    # Read the reference period and the years of interest in one go
+    span = _span_rows(ref_rows, rows)
+    span_samps = _read_rows(dsets, span, cols, dtype)
+    ref_samps = span_samps[_shift_rows(ref_rows, span)]
+    samps = span_samps[_shift_rows(rows, span)]
+
+    # Calculate the reference period values (mean between refyear_start and refyear_end inclusive)
+    # and subtract them from the years of interest
+    ref_vals = np.mean(ref_samps, axis=0, dtype=np.float64)[None, :]
+    samps = np.subtract(samps, ref_vals, dtype=samps.dtype)
+    years = years[rows]
 
     # Close the input file
-    hf.close()
+    if not keep_open:
+        hf.close()
 
     # Create the 2lm dictionary
     out_dict = {"samples": samps.T, "years": years}
     return out_dict
 
 
+def _climate_file(climate_fname, climate_format="auto"):
+    # Return the climate file, opening it unless it is kept open, and whether it is
+    # kept open (and so must not be closed by the caller)
+    hf = _open_climate_files.get(os.path.realpath(climate_fname))
+    if hf is None:
+        return (OpenClimate(climate_fname, climate_format), False)
+    return (hf, True)
+
+
+def _year_rows(years, first=None, last=None):
+    # Slice of the rows of "years" between the years first and last inclusive
+    start = 0 if first is None else np.searchsorted(years, first, side="left")
+    stop = len(years) if last is None else np.searchsorted(years, last, side="right")
+    return slice(int(start), int(max(start, stop)))
+
+
+def _span_rows(*rows):
+    # Smallest slice of rows covering all the given slices
+    return slice(min(x.start for x in rows), max(x.stop for x in rows))
+
+
+def _shift_rows(rows, span):
+    # Express the slice "rows" relative to the start of the slice "span"
+    return slice(rows.start - span.start, rows.stop - span.start)
+
+
+def _read_rows(dsets, rows, cols=None, dtype=None):
+    # Read the slice "rows" of one or more [years, samples] datasets, side by side,
+    # into one preallocated [rows, samples] array (of dtype, by default the type of
+    # the datasets), optionally only the columns cols[i] (sorted) of dataset i.
+    # Several datasets are read concurrently, each into its own block of columns.
+    if cols is None:
+        ncols = [dset.shape[1] for dset in dsets]
+    else:
+        ncols = [len(x) for x in cols]
+    col_starts = np.concatenate(([0], np.cumsum(ncols)))
+    if dtype is None:
+        dtype = np.result_type(*[dset.dtype for dset in dsets])
+    out = np.empty((rows.stop - rows.start, col_starts[-1]), dtype=dtype)
+    if out.size == 0:
+        return out
+
+    def read(i):
+        if ncols[i] == 0:
+            return
+        dest = np.s_[:, col_starts[i] : col_starts[i + 1]]
+        if hasattr(dsets[i], "read_direct"):
+            source = np.s_[rows, :] if cols is None else np.s_[rows, cols[i]]
+            dsets[i].read_direct(out, source, dest)
+        elif cols is None:
+            out[dest] = dsets[i][rows, :]
+        elif hasattr(dsets[i], "oindex"):
+            out[dest] = dsets[i].oindex[rows, cols[i]]
+        else:
+            out[dest] = dsets[i][rows, cols[i]]
+
+    if len(dsets) == 1:
+        read(0)
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(dsets), 8)) as pool:
+            list(pool.map(read, range(len(dsets))))
+
+    return out
+
+
+def _peak_index(
+    climate_fname, temp_dsets, window_rows, twinyear_start, twinyear_end, cache_dir
+):
+    # Return the peak temperature over the window of every sample, sorted, with the
+    # scenario (index into temp_dsets) and column of each sample
+    if cache_dir is not None:
+        key = PEAK_CACHE_PREFIX + filecache.cache_key(
+            "peak-index-v1",
+            filecache.file_digest(climate_fname, cache_dir),
+            twinyear_start,
+            twinyear_end,
+        )
+        peak_index = filecache.load_array(cache_dir, key)
+        if peak_index is not None:
+            return peak_index
+
+    # Peak temperature of each sample over the window
+    peaks = np.nanmax(_read_rows(temp_dsets, window_rows), axis=0)
+    ncols = [dset.shape[1] for dset in temp_dsets]
+
+    peak_index = np.empty(
+        len(peaks), dtype=[("peak", "f8"), ("scenario", "i4"), ("column", "i8")]
+    )
+    peak_index["peak"] = peaks
+    peak_index["scenario"] = np.repeat(np.arange(len(ncols)), ncols)
+    peak_index["column"] = np.concatenate([np.arange(n) for n in ncols])
+    peak_index = peak_index[np.argsort(peaks, kind="stable")]
+
+    if cache_dir is not None:
+        filecache.save_array(cache_dir, key, peak_index)
+        filecache.evict(cache_dir, PEAK_CACHE_MAX_BYTES, prefix=PEAK_CACHE_PREFIX)
+
+    return peak_index
+
+
 """
 Filter2lmData()
 
@@ -154,6 +304,48 @@ def Filter2lmData(tlm_dict, filter_years=None, tmin=-np.inf, tmax=np.inf):
     return out_dict
 
 
+def Unique2lmSamples(samps):
+    # Find the distinct trajectories (rows) of a [samples, years] array, such as the
+    # two-layer model data, which holds only 44 unique trajectories, or an ensemble
+    # resampled with replacement. Returns (unique, sample_map) with
+    # samps == unique[sample_map], or (None, None) if every row is distinct.
+    # Ensembles without repeats, the usual case, are recognized by a hash of the bits
+    # of each row, without sorting the whole array.
+    if not _rows_may_repeat(samps):
+        return (None, None)
+    (unique, sample_map) = np.unique(samps, axis=0, return_inverse=True)
+    if len(unique) == len(samps):
+        return (None, None)
+    return (unique, sample_map.reshape(-1))
+
+
+def _rows_may_repeat(samps, blocksize=10000):
+    # Whether some rows of a [samples, years] array may be equal. Equal rows have
+    # equal hashes of their bits, so if all the hashes differ, all the rows do.
+    if samps.shape[0] < 2:
+        return False
+    bits = np.ascontiguousarray(samps).view("u{0}".format(samps.dtype.itemsize))
+    weights = np.random.default_rng(0).integers(
+        1, 2**63, size=bits.shape[1], dtype=np.uint64
+    )
+    hashes = np.empty(bits.shape[0], dtype=np.uint64)
+    for start in range(0, bits.shape[0], blocksize):
+        block = slice(start, start + blocksize)
+        hashes[block] = bits[block].astype(np.uint64, copy=False) @ weights
+    return len(np.unique(hashes)) < len(hashes)
+
+
+def Integrate2lmSamples(samps, blocksize=10000):
+    # Integrate [samples, years] temperatures over the years (cumulative sum) to K yr
+    # at the ends of calendar years. The sums are accumulated in double precision, in
+    # blocks of samples, and returned in the type of samps.
+    out = np.empty(samps.shape, dtype=samps.dtype)
+    for start in range(0, samps.shape[0], blocksize):
+        block = slice(start, start + blocksize)
+        out[block] = np.cumsum(samps[block], axis=1, dtype=np.float64)
+    return out
+
+
 if __name__ == "__main__":
     # varname = "ocean_heat_content"
     varname = "surface_temperature"
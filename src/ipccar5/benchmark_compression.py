@@ -0,0 +1,149 @@
+import os
+import shutil
+import tempfile
+import time
+
+import xarray as xr
+
+from ipccar5.write_output import (
+    COMPRESSED_VARIABLES,
+    COMPRESSION_CODECS,
+    CodecAvailable,
+    CompressionPolicy,
+    PackingRanges,
+    WriteOutput,
+)
+
+""" benchmark_compression.py
+
+Measures the compression policies of write_output.py on an actual output file of the
+workflows, to choose the codec, level and shuffle filter for a deployment.
+
+The file is loaded into memory once and then written with every combination of the
+requested codecs and levels to a temporary file (or store), which is timed, measured
+and read back before it is deleted. Codecs whose NetCDF filters are not available are
+reported as unavailable.
+
+Parameters:
+input_file = NetCDF file or Zarr store written by the workflows
+codecs = Codecs to try (default: all of COMPRESSION_CODECS)
+levels = Compression levels to try for each codec
+shuffle = Whether to apply the byte-shuffle filter
+output_format = Format to write, "netcdf" or "zarr"
+tmp_dir = Directory for the temporary files (default: the system default)
+packing = Optional packing policy applied before compressing (see write_output.py)
+
+Return:
+List of dictionaries, one per codec and level, with the codec, level, shuffle,
+available, size (bytes, of the whole file or store), ratio (uncompressed size of the
+compressed variables over that size), write_mbs and read_mbs (uncompressed MB of the
+compressed variables per second)
+
+"""
+
+
+def BenchmarkCompression(
+    input_file,
+    codecs=None,
+    levels=(1, 4, 9),
+    shuffle=True,
+    output_format="netcdf",
+    tmp_dir=None,
+    packing=None,
+):
+    if codecs is None:
+        codecs = COMPRESSION_CODECS
+
+    # Load the dataset, keeping the type and fill value of the variables
+    input_engine = "zarr" if os.path.isdir(input_file) else "netcdf4"
+    with xr.open_dataset(input_file, engine=input_engine, mask_and_scale=False) as src:
+        ds = src.load()
+    encoding = {}
+    for name in ds.data_vars:
+        encoding[name] = {"dtype": ds[name].dtype}
+        if "_FillValue" in ds[name].attrs:
+            encoding[name]["_FillValue"] = ds[name].attrs.pop("_FillValue")
+    variables = [name for name in COMPRESSED_VARIABLES if name in ds.variables]
+
+    # The outputs are read back in the format they are written in
+    output_engine = "zarr" if output_format == "zarr" else "netcdf4"
+    nbytes = sum(ds[name].nbytes for name in variables)
+    (packing_ranges,) = PackingRanges([ds], packing)
+
+    results = []
+    work_dir = tempfile.mkdtemp(dir=tmp_dir)
+    try:
+        for codec in codecs:
+            if not CodecAvailable(codec, output_format):
+                results.append(
+                    {
+                        "codec": codec,
+                        "level": None,
+                        "shuffle": shuffle,
+                        "available": False,
+                    }
+                )
+                continue
+
+            # The level does not apply without compression
+            for level in [0] if codec == "none" else levels:
+                path = os.path.join(work_dir, "benchmark")
+                policy = CompressionPolicy(codec, level, shuffle, variables)
+
+                # Time the write
+                t0 = time.perf_counter()
+                WriteOutput(
+                    ds,
+                    path,
+                    encoding=encoding,
+                    output_format=output_format,
+                    compression=policy,
+                    packing=packing,
+                    packing_ranges=packing_ranges,
+                )
+                write_time = time.perf_counter() - t0
+                size = _path_size(path)
+
+                # Time reading the compressed variables back
+                t0 = time.perf_counter()
+                with xr.open_dataset(path, engine=output_engine) as out:
+                    for name in variables:
+                        out[name].load()
+                read_time = time.perf_counter() - t0
+
+                results.append(
+                    {
+                        "codec": codec,
+                        "level": level,
+                        "shuffle": shuffle,
+                        "available": True,
+                        "size": size,
+                        "ratio": nbytes / size,
+                        "write_mbs": nbytes / 1e6 / write_time,
+                        "read_mbs": nbytes / 1e6 / read_time,
+                    }
+                )
+                _remove_path(path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def _path_size(path):
+    # Size in bytes of a file, or of all files below a directory
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(path)
+        for name in files
+    )
+
+
+def _remove_path(path):
+    # Remove a file or a directory tree
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
@@ -9,6 +9,28 @@ from ipccar5.ipccar5_icesheets_preprocess import ar5_preprocess_icesheets
 from ipccar5.ipccar5_icesheets_fit import ar5_fit_icesheets
 from ipccar5.ipccar5_icesheets_project import ar5_project_icesheets
 from ipccar5.ipccar5_icesheets_postprocess import ar5_postprocess_icesheets
+
+from ipccar5.ipccar5_all import (
+    GLACIER_CHUNKSIZE,
+    ICESHEET_CHUNKSIZE,
+    ar5_run_all,
+    ar5_run_batch,
+    check_batch_args,
+)
+
+from ipccar5.input_bundle import WriteBundle, ReadBundle
+from ipccar5.preprocess_cache import preprocess_end_year
+from ipccar5.write_output import (
+    OUTPUT_FORMATS,
+    COMPRESSION_CODECS,
+    PACKING_TYPES,
+    CHUNK_LAYOUTS,
+    ChunkPolicy,
+    CodecAvailable,
+    CompressionPolicy,
+    PackingPolicy,
+)
+from ipccar5.benchmark_compression import BenchmarkCompression
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -20,141 +42,354 @@ def main():
     pass
 
 
-@main.command()
-@click.option(
-    "--scenario",
-    type=str,
-    help="Scenario",
-)
-@click.option(
-    "--refyear-start",
-    default=1986,
-    show_default=True,
-    type=int,
-    help="Start year for reference period",
+def _options(*options):
+    # Decorator adding a group of click options to a command, listed in this order
+    def decorate(f):
+        for option in reversed(options):
+            f = option(f)
+        return f
+
+    return decorate
+
+
+def _output_file_options(files, template=False):
+    # Options of output files given as (option, description) pairs. The batch command
+    # takes templates of the file names, in which "{scenario}" is replaced.
+    suffix = ", with '{scenario}' in place of the scenario" if template else ""
+    return _options(
+        *[
+            click.option(
+                option,
+                type=str,
+                help="Path to {0} output sea-level file{1}".format(description, suffix),
+            )
+            for (option, description) in files
+        ]
+    )
+
+
+# Scenario and identifier of the glaciers, icesheets and all commands
+_scenario_options = _options(
+    click.option(
+        "--scenario",
+        type=str,
+        help="Scenario",
+    ),
+    click.option(
+        "--pipeline-id",
+        type=str,
+        help="Unique identifier for this instance of the module",
+    ),
 )
-@click.option(
-    "--refyear-end",
-    default=2005,
-    show_default=True,
-    type=int,
-    help="End year for reference period",
+
+# Reference period of the temperatures and first year of their time integral
+_reference_options = _options(
+    click.option(
+        "--refyear-start",
+        default=1986,
+        show_default=True,
+        type=int,
+        help="Start year for reference period",
+    ),
+    click.option(
+        "--refyear-end",
+        default=2005,
+        show_default=True,
+        type=int,
+        help="End year for reference period",
+    ),
+    click.option(
+        "--start-year",  # this is same as baseyear
+        default=2005,
+        show_default=True,
+        type=int,
+        help="Year from which to start integrating temperature",
+    ),
 )
-@click.option(
-    "--start-year",  # this is same as baseyear
-    default=2005,
-    show_default=True,
-    type=int,
-    help="Year from which to start integrating temperature",
+
+# Climate data file and how it is read and preprocessed
+_climate_options = _options(
+    click.option(
+        "--tlm-flag",
+        default=1,
+        show_default=True,
+        type=int,
+        help="Use the two-layer model data, 1=yes",
+    ),
+    click.option(
+        "--climate-data-file",
+        type=str,
+        help="NetCDF4/HDF5 file or Zarr store containing surface temperature data (this should be a fair output)",
+        required=True,
+    ),
+    click.option(
+        "--climate-cache-dir",
+        type=str,
+        help="Directory for a persistent cache of data derived from the climate data file: the preprocessed temperatures, shared by the glaciers and icesheets commands, and the peak-temperature index used by temperature target scenarios (no caching if not set)",
+    ),
+    click.option(
+        "--climate-cache-max-mb",
+        default=4096,
+        show_default=True,
+        type=int,
+        help="Size bound of the preprocessed temperatures in the climate cache in MB, least recently used entries are evicted beyond it",
+    ),
+    click.option(
+        "--climate-format",
+        default="auto",
+        show_default=True,
+        type=click.Choice(["auto", "hdf5", "netcdf", "zarr"]),
+        help="Format of the climate data file: HDF5 or NETCDF4 file (read with h5py or, with 'netcdf', with netCDF4) or Zarr store, with one group per scenario; classic NetCDF files are not supported ('auto' guesses it from the path)",
+    ),
+    click.option(
+        "--precision",
+        default="float64",
+        show_default=True,
+        type=click.Choice(["float64", "float32"]),
+        help="Floating point type of the temperature samples, projections and localized projections (float32 halves their memory; time integrals are still accumulated in float64)",
+    ),
+    click.option(
+        "--stream-chunk-samples",
+        type=int,
+        help="Preprocess the climate data in chunks of this many samples, keeping the samples in temporary files on disk, for ensembles too large for memory (standard scenarios only; in memory if not set)",
+    ),
 )
-@click.option(
-    "--end-year",
-    default=2301,
-    show_default=True,
-    type=int,
-    help="Year to end the projection (Used in preprocess).",
+
+# Format, compression, packing and chunking of the output files
+_output_options = _options(
+    click.option(
+        "--output-format",
+        default="netcdf",
+        show_default=True,
+        type=click.Choice(OUTPUT_FORMATS),
+        help="Format of the output files: NetCDF4 files, or Zarr stores (directories) written with parallel, Blosc/Zstd compressed chunks",
+    ),
+    click.option(
+        "--compression",
+        default="default",
+        show_default=True,
+        type=click.Choice(["default"] + list(COMPRESSION_CODECS)),
+        help="Compression codec of the sea-level change variables ('default' is zlib for NetCDF and Blosc/Zstd for Zarr; zstd, bzip2 and the blosc codecs need their netCDF4 filter plugins)",
+    ),
+    click.option(
+        "--compression-level",
+        default=4,
+        show_default=True,
+        type=int,
+        help="Compression level",
+    ),
+    click.option(
+        "--shuffle/--no-shuffle",
+        default=True,
+        show_default=True,
+        help="Apply the byte-shuffle filter before compressing",
+    ),
+    click.option(
+        "--variable-compression-level",
+        multiple=True,
+        type=str,
+        help="Compression level of one variable as VARIABLE=LEVEL, which is then compressed as well (may be repeated)",
+    ),
+    click.option(
+        "--pack",
+        default="none",
+        show_default=True,
+        type=click.Choice(["none"] + list(PACKING_TYPES)),
+        help="Store the sea-level change variables as integers with scale_factor and add_offset, decoded transparently by xarray",
+    ),
+    click.option(
+        "--pack-resolution",
+        default=0.1,
+        show_default=True,
+        type=float,
+        help="Largest step between packed values in mm (widened, with a warning, if the range of the values does not fit the integer type)",
+    ),
+    click.option(
+        "--bitround-keepbits",
+        type=int,
+        help="Bit-round the sea-level change variables, keeping this many mantissa bits (not with --pack)",
+    ),
+    click.option(
+        "--chunk-layout",
+        default="default",
+        show_default=True,
+        type=click.Choice(["default"] + list(CHUNK_LAYOUTS)),
+        help="Chunk layout of the local output files: one chunk per location with all its samples and years ('location', for reading one site at a time), or chunks of a few samples at many locations ('sample')",
+    ),
+    click.option(
+        "--chunk-shape",
+        type=str,
+        help="Chunk shape of the local output files as SAMPLES,YEARS,LOCATIONS (-1 for a whole dimension), overriding --chunk-layout",
+    ),
+    click.option(
+        "--chunk-cache-mb",
+        type=float,
+        help="HDF5 chunk cache of the local output variables while they are written, in MB (default with --chunk-layout or --chunk-shape: enough for the chunks of one block of locations)",
+    ),
 )
-@click.option(
-    "--tlm-flag",
-    default=1,
-    show_default=True,
-    type=int,
-    help="Use the two-layer model data, 1=yes",
+
+# Projection years and samples
+_projection_options = _options(
+    click.option(
+        "--rng-seed",
+        default=1234,
+        show_default=True,
+        type=int,
+        help="Seed value for random number generator",
+    ),
+    click.option(
+        "--pyear-start",
+        default=2020,
+        show_default=True,
+        type=int,
+        help="Projection start year",
+    ),
+    click.option(
+        "--pyear-end",
+        default=2150,
+        show_default=True,
+        type=int,
+        help="Projection end year",
+    ),
+    click.option(
+        "--pyear-step",
+        default=10,
+        show_default=True,
+        type=int,
+        help="Projection year step",
+    ),
+    click.option(
+        "--nmsamps",
+        default=1000,
+        show_default=True,
+        required=False,
+        type=int,
+        help="Number of method samples to generate",
+    ),
+    click.option(
+        "--ntsamps",
+        default=450,
+        show_default=True,
+        required=False,
+        type=int,
+        help="Number of climate samples to generate",
+    ),
+    click.option(
+        "--nsamps",
+        required=False,
+        type=int,
+        help="Total number of samples to generate (replaces 'nmsamps' and 'ntsamps' if provided)",
+    ),
 )
-@click.option(
-    "--pipeline-id", type=str, help="Unique identifier for this instance of the module"
+
+# Calibration and regional fractions of the glacier projections
+_glacier_options = _options(
+    click.option(
+        "--use-gmip",
+        help="Use the GMIP calibration",
+        default=2,
+        show_default=True,
+        type=click.Choice([0, 1, 2]),
+    ),
+    click.option(
+        "--glacier-fraction-file",
+        type=str,
+        help="Path to glacier fraction file",
+    ),
 )
-@click.option(
-    "--climate-data-file",
-    type=str,
-    help="NetCDF4/HDF5 file containing surface temperature data (this should be a fair output)",
-    required=True,
+
+# Fractions of the ice sheet projections
+_icesheet_options = _options(
+    click.option(
+        "--icesheet-fraction-file",
+        type=str,
+        help="Path to icesheet fraction file",
+    ),
 )
-@click.option(
-    "--rng-seed",
-    default=1234,
-    show_default=True,
-    type=int,
-    help="Seed value for random number generator",
+
+# Locations and fingerprints of the localized projections
+_localize_options = _options(
+    click.option(
+        "--location-file",
+        help="File that contains name, id, lat, and lon of points for localization",
+    ),
+    click.option(
+        "--fingerprint-dir",
+        type=str,
+        help="Path to fingerprint directory (required unless --input-bundle is given)",
+    ),
+    click.option(
+        "--input-bundle",
+        type=str,
+        help="Input bundle created by 'ipccar5 bundle'. Supplies the fingerprints, fraction tables and locations that are not given by their own options",
+    ),
+    click.option(
+        "--fingerprint-cache-dir",
+        type=str,
+        help="Directory for a persistent cache of fingerprints interpolated to the locations (no caching if not set)",
+    ),
+    click.option(
+        "--fingerprint-cache-max-mb",
+        default=1024,
+        show_default=True,
+        type=int,
+        help="Size bound of the fingerprint cache in MB, least recently used entries are evicted beyond it",
+    ),
 )
-@click.option(
-    "--pyear-start",
-    default=2020,
-    show_default=True,
-    type=int,
-    help="Projection start year",
+
+# Output files of the glaciers and ice sheets workflows
+_GLACIER_OUTPUT_FILES = (
+    ("--global-glacier-output-file", "global glacier"),
+    ("--local-glacier-output-file", "local glacier"),
 )
-@click.option(
-    "--pyear-end",
-    default=2150,
-    show_default=True,
-    type=int,
-    help="Projection end year",
+_GLOBAL_ICESHEET_OUTPUT_FILES = (
+    ("--global-gis-output-file", "global GIS"),
+    ("--global-ais-output-file", "global AIS"),
+    ("--global-wais-output-file", "global WAIS"),
+    ("--global-eais-output-file", "global EAIS"),
 )
-@click.option(
-    "--pyear-step",
-    default=10,
-    show_default=True,
-    type=int,
-    help="Projection year step",
+_LOCAL_ICESHEET_OUTPUT_FILES = (
+    ("--local-gis-output-file", "local GIS"),
+    ("--local-ais-output-file", "local AIS"),
+    ("--local-wais-output-file", "local WAIS"),
+    ("--local-eais-output-file", "local EAIS"),
 )
-@click.option(
-    "--nmsamps",
-    default=1000,
-    show_default=True,
-    required=False,
+_ICESHEET_OUTPUT_FILES = _GLOBAL_ICESHEET_OUTPUT_FILES + _LOCAL_ICESHEET_OUTPUT_FILES
+
+# Number of locations localized at a time by the all and batch commands, by default
+# that of the glaciers and icesheets commands in each branch
+_branch_chunksize_option = click.option(
+    "--chunksize",
     type=int,
-    help="Number of method samples to generate",
+    help="Number of locations to process at a time [default: {0} for the glaciers, {1} for the ice sheets]".format(
+        GLACIER_CHUNKSIZE, ICESHEET_CHUNKSIZE
+    ),
 )
+
+
+@main.command()
+@_scenario_options
+@_reference_options
 @click.option(
-    "--ntsamps",
-    default=450,
+    "--end-year",
+    default=2301,
     show_default=True,
-    required=False,
-    type=int,
-    help="Number of climate samples to generate",
-)
-@click.option(
-    "--nsamps",
-    required=False,
     type=int,
-    help="Total number of samples to generate (replaces 'nmsamps' and 'ntsamps' if provided)",
-)
-@click.option(
-    "--use-gmip",
-    help="Use the GMIP calibration",
-    default=2,
-    show_default=True,
-    type=click.Choice([0, 1, 2]),
-)
-@click.option(
-    "--glacier-fraction-file",
-    type=str,
-    help="Path to glacier fraction file",
-)
-@click.option(
-    "--global-output-file",
-    type=str,
-    help="Path to global output sea-level file",
-)
-@click.option(
-    "--location-file",
-    help="File that contains name, id, lat, and lon of points for localization",
+    help="Year to end the projection (Used in preprocess).",
 )
+@_climate_options
+@_output_options
+@_projection_options
+@_glacier_options
+@_output_file_options([("--global-output-file", "global")])
+@_localize_options
 @click.option(
     "--chunksize",
     help="Number of locations to process at a time",
     type=int,
-    default=20,
-)
-@click.option(
-    "--fingerprint-dir", type=str, help="Path to fingerprint directory", required=True
-)
-@click.option(
-    "--local-output-file",
-    type=str,
-    help="Path to local output sea-level file",
+    default=GLACIER_CHUNKSIZE,
 )
+@_output_file_options([("--local-output-file", "local")])
 def glaciers(
     scenario,
     refyear_start,
@@ -164,6 +399,22 @@ def glaciers(
     tlm_flag,
     pipeline_id,
     climate_data_file,
+    climate_cache_dir,
+    climate_cache_max_mb,
+    stream_chunk_samples,
+    climate_format,
+    precision,
+    output_format,
+    compression,
+    compression_level,
+    shuffle,
+    variable_compression_level,
+    pack,
+    pack_resolution,
+    bitround_keepbits,
+    chunk_layout,
+    chunk_shape,
+    chunk_cache_mb,
     rng_seed,
     pyear_start,
     pyear_end,
@@ -177,19 +428,43 @@ def glaciers(
     location_file,
     chunksize,
     fingerprint_dir,
+    input_bundle,
+    fingerprint_cache_dir,
+    fingerprint_cache_max_mb,
     local_output_file,
 ):
     click.echo("Hello from ipccar5-glaciers!")
 
+    if fingerprint_dir is None and input_bundle is None:
+        raise click.UsageError("One of --fingerprint-dir or --input-bundle is required")
+    bundle = ReadBundle(input_bundle) if input_bundle else None
+    compression_policy = _compression_policy(
+        compression,
+        compression_level,
+        shuffle,
+        variable_compression_level,
+        output_format,
+    )
+    packing_policy = _packing_policy(pack, pack_resolution, bitround_keepbits)
+    chunk_policy = _chunk_policy(chunk_layout, chunk_shape, chunk_cache_mb)
+
+    # Only the years up to the end of the projection, and at least to 2100 as for the
+    # ice sheets (so that both commands share the preprocess cache), are read from
+    # the climate data
     preprocess_dict = ar5_preprocess_glaciers(
         scenario,
         refyear_start,
         refyear_end,
         start_year,
-        end_year,
+        preprocess_end_year(pyear_end, end_year),
         tlm_flag,
         pipeline_id,
         climate_fname=climate_data_file,
+        cache_dir=climate_cache_dir,
+        cache_max_bytes=climate_cache_max_mb * 2**20,
+        stream_chunk=stream_chunk_samples,
+        climate_format=climate_format,
+        precision=precision,
     )
 
     fit_dict = ar5_fit_glaciers(
@@ -209,6 +484,10 @@ def glaciers(
         pipeline_id=pipeline_id,
         glacier_fraction_file=glacier_fraction_file,
         global_output_file=global_output_file,
+        input_bundle=bundle,
+        output_format=output_format,
+        compression=compression_policy,
+        packing=packing_policy,
     )
 
     ar5_postprocess_glaciers(
@@ -219,166 +498,54 @@ def glaciers(
         preprocess_dict=preprocess_dict,
         fingerprint_dir=fingerprint_dir,
         local_output_file=local_output_file,
+        fingerprint_cache_dir=fingerprint_cache_dir,
+        fingerprint_cache_max_bytes=fingerprint_cache_max_mb * 2**20,
+        input_bundle=bundle,
+        output_format=output_format,
+        compression=compression_policy,
+        packing=packing_policy,
+        chunking=chunk_policy,
     )
 
 
 @main.command()
-@click.option(
-    "--scenario",
-    type=str,
-    help="Scenario",
-)
-@click.option(
-    "--refyear-start",
-    default=1986,
-    show_default=True,
-    type=int,
-    help="Start year for reference period",
-)
-@click.option(
-    "--refyear-end",
-    default=2005,
-    show_default=True,
-    type=int,
-    help="End year for reference period",
-)
-@click.option(
-    "--start-year",  # this is same as baseyear
-    default=2005,  # may want this to be 2006?
-    show_default=True,
-    type=int,
-    help="Year from which to start integrating temperature",
-)
-@click.option(
-    "--tlm-flag",
-    default=1,
-    show_default=True,
-    type=int,
-    help="Use the two-layer model data, 1=yes",
-)
-@click.option(
-    "--pipeline-id", type=str, help="Unique identifier for this instance of the module"
-)
-@click.option(
-    "--climate-data-file",
-    type=str,
-    help="NetCDF4/HDF5 file containing surface temperature data (this should be a fair output)",
-    required=True,
-)
-@click.option(
-    "--rng-seed",
-    default=1234,
-    show_default=True,
-    type=int,
-    help="Seed value for random number generator",
-)
-@click.option(
-    "--pyear-start",
-    default=2020,
-    show_default=True,
-    type=int,
-    help="Projection start year",
-)
-@click.option(
-    "--pyear-end",
-    default=2150,
-    show_default=True,
-    type=int,
-    help="Projection end year",
-)
-@click.option(
-    "--pyear-step",
-    default=10,
-    show_default=True,
-    type=int,
-    help="Projection year step",
-)
-@click.option(
-    "--nmsamps",
-    default=1000,
-    show_default=True,
-    required=False,
-    type=int,
-    help="Number of method samples to generate",
-)
-@click.option(
-    "--ntsamps",
-    default=450,
-    show_default=True,
-    required=False,
-    type=int,
-    help="Number of climate samples to generate",
-)
-@click.option(
-    "--nsamps",
-    required=False,
-    type=int,
-    help="Total number of samples to generate (replaces 'nmsamps' and 'ntsamps' if provided)",
-)
-@click.option(
-    "--icesheet-fraction-file",
-    type=str,
-    help="Path to icesheet fraction file",
-)
-@click.option(
-    "--global-gis-output-file",
-    type=str,
-    help="Path to global GIS output sea-level file",
-)
-@click.option(
-    "--global-ais-output-file",
-    type=str,
-    help="Path to global AIS output sea-level file",
-)
-@click.option(
-    "--global-wais-output-file",
-    type=str,
-    help="Path to global WAIS output sea-level file",
-)
-@click.option(
-    "--global-eais-output-file",
-    type=str,
-    help="Path to global EAIS output sea-level file",
-)
-@click.option(
-    "--location-file",
-    help="File that contains name, id, lat, and lon of points for localization",
-)
+@_scenario_options
+@_reference_options
+@_climate_options
+@_output_options
+@_projection_options
+@_icesheet_options
+@_output_file_options(_GLOBAL_ICESHEET_OUTPUT_FILES)
+@_localize_options
 @click.option(
     "--chunksize",
     help="Number of locations to process at a time",
     type=int,
-    default=50,
-)
-@click.option(
-    "--fingerprint-dir", type=str, help="Path to fingerprint directory", required=True
-)
-@click.option(
-    "--local-gis-output-file",
-    type=str,
-    help="Path to local GIS output sea-level file",
-)
-@click.option(
-    "--local-ais-output-file",
-    type=str,
-    help="Path to local AIS output sea-level file",
-)
-@click.option(
-    "--local-wais-output-file",
-    type=str,
-    help="Path to local WAIS output sea-level file",
-)
-@click.option(
-    "--local-eais-output-file",
-    type=str,
-    help="Path to local EAIS output sea-level file",
+    default=ICESHEET_CHUNKSIZE,
 )
+@_output_file_options(_LOCAL_ICESHEET_OUTPUT_FILES)
 def icesheets(
     scenario,
     start_year,
     tlm_flag,
     pipeline_id,
     climate_data_file,
+    climate_cache_dir,
+    climate_cache_max_mb,
+    stream_chunk_samples,
+    climate_format,
+    precision,
+    output_format,
+    compression,
+    compression_level,
+    shuffle,
+    variable_compression_level,
+    pack,
+    pack_resolution,
+    bitround_keepbits,
+    chunk_layout,
+    chunk_shape,
+    chunk_cache_mb,
     refyear_start,
     refyear_end,
     rng_seed,
@@ -391,6 +558,9 @@ def icesheets(
     location_file,
     chunksize,
     fingerprint_dir,
+    input_bundle,
+    fingerprint_cache_dir,
+    fingerprint_cache_max_mb,
     icesheet_fraction_file,
     global_gis_output_file,
     global_ais_output_file,
@@ -403,6 +573,19 @@ def icesheets(
 ):
     click.echo("Hello from the ipccar5-icesheets!")
 
+    if fingerprint_dir is None and input_bundle is None:
+        raise click.UsageError("One of --fingerprint-dir or --input-bundle is required")
+    bundle = ReadBundle(input_bundle) if input_bundle else None
+    compression_policy = _compression_policy(
+        compression,
+        compression_level,
+        shuffle,
+        variable_compression_level,
+        output_format,
+    )
+    packing_policy = _packing_policy(pack, pack_resolution, bitround_keepbits)
+    chunk_policy = _chunk_policy(chunk_layout, chunk_shape, chunk_cache_mb)
+
     preprocess_dict = ar5_preprocess_icesheets(
         scenario=scenario,
         startyr=start_year,
@@ -411,6 +594,14 @@ def icesheets(
         climate_fname=climate_data_file,
         refyear_start=refyear_start,
         refyear_end=refyear_end,
+        # Only the years up to the end of the projection, and at least to 2100 where
+        # the ice-sheet dynamics ranges are defined, are read from the climate data
+        endyr=preprocess_end_year(pyear_end),
+        cache_dir=climate_cache_dir,
+        cache_max_bytes=climate_cache_max_mb * 2**20,
+        stream_chunk=stream_chunk_samples,
+        climate_format=climate_format,
+        precision=precision,
     )
 
     fit_dict = ar5_fit_icesheets(
@@ -436,6 +627,10 @@ def icesheets(
         global_ais_output_file=global_ais_output_file,
         global_wais_output_file=global_wais_output_file,
         global_eais_output_file=global_eais_output_file,
+        input_bundle=bundle,
+        output_format=output_format,
+        compression=compression_policy,
+        packing=packing_policy,
     )
 
     ar5_postprocess_icesheets(
@@ -449,4 +644,508 @@ def icesheets(
         local_ais_output_file=local_ais_output_file,
         local_wais_output_file=local_wais_output_file,
         local_eais_output_file=local_eais_output_file,
+        fingerprint_cache_dir=fingerprint_cache_dir,
+        fingerprint_cache_max_bytes=fingerprint_cache_max_mb * 2**20,
+        input_bundle=bundle,
+        output_format=output_format,
+        compression=compression_policy,
+        packing=packing_policy,
+        chunking=chunk_policy,
+    )
+
+
+@main.command(name="all")
+@_scenario_options
+@_reference_options
+@_climate_options
+@_output_options
+@_projection_options
+@_glacier_options
+@_icesheet_options
+@_localize_options
+@_branch_chunksize_option
+@click.option(
+    "--workers",
+    type=int,
+    help="Number of branches (glaciers, icesheets) to run at a time [default: 2 if more than one core is available, otherwise 1]",
+)
+@_output_file_options(_GLACIER_OUTPUT_FILES + _ICESHEET_OUTPUT_FILES)
+def run_all(
+    scenario,
+    refyear_start,
+    refyear_end,
+    start_year,
+    tlm_flag,
+    pipeline_id,
+    climate_data_file,
+    climate_cache_dir,
+    climate_cache_max_mb,
+    stream_chunk_samples,
+    climate_format,
+    precision,
+    output_format,
+    compression,
+    compression_level,
+    shuffle,
+    variable_compression_level,
+    pack,
+    pack_resolution,
+    bitround_keepbits,
+    chunk_layout,
+    chunk_shape,
+    chunk_cache_mb,
+    rng_seed,
+    pyear_start,
+    pyear_end,
+    pyear_step,
+    nmsamps,
+    ntsamps,
+    nsamps,
+    use_gmip,
+    glacier_fraction_file,
+    icesheet_fraction_file,
+    location_file,
+    chunksize,
+    fingerprint_dir,
+    input_bundle,
+    fingerprint_cache_dir,
+    fingerprint_cache_max_mb,
+    workers,
+    global_glacier_output_file,
+    local_glacier_output_file,
+    global_gis_output_file,
+    global_ais_output_file,
+    global_wais_output_file,
+    global_eais_output_file,
+    local_gis_output_file,
+    local_ais_output_file,
+    local_wais_output_file,
+    local_eais_output_file,
+):
+    """Run the glaciers and icesheets workflows together, sharing their inputs."""
+    click.echo("Hello from ipccar5-all!")
+
+    if fingerprint_dir is None and input_bundle is None:
+        raise click.UsageError("One of --fingerprint-dir or --input-bundle is required")
+    bundle = ReadBundle(input_bundle) if input_bundle else None
+    compression_policy = _compression_policy(
+        compression,
+        compression_level,
+        shuffle,
+        variable_compression_level,
+        output_format,
+    )
+    packing_policy = _packing_policy(pack, pack_resolution, bitround_keepbits)
+    chunk_policy = _chunk_policy(chunk_layout, chunk_shape, chunk_cache_mb)
+
+    ar5_run_all(
+        scenario=scenario,
+        refyear_start=refyear_start,
+        refyear_end=refyear_end,
+        start_year=start_year,
+        tlm_flag=tlm_flag,
+        pipeline_id=pipeline_id,
+        climate_fname=climate_data_file,
+        rng_seed=rng_seed,
+        pyear_start=pyear_start,
+        pyear_end=pyear_end,
+        pyear_step=pyear_step,
+        nmsamps=nmsamps,
+        ntsamps=ntsamps,
+        nsamps=nsamps,
+        use_gmip=use_gmip,
+        glacier_fraction_file=glacier_fraction_file,
+        icesheet_fraction_file=icesheet_fraction_file,
+        location_file=location_file,
+        chunksize=chunksize,
+        fingerprint_dir=fingerprint_dir,
+        global_glacier_output_file=global_glacier_output_file,
+        local_glacier_output_file=local_glacier_output_file,
+        global_gis_output_file=global_gis_output_file,
+        global_ais_output_file=global_ais_output_file,
+        global_wais_output_file=global_wais_output_file,
+        global_eais_output_file=global_eais_output_file,
+        local_gis_output_file=local_gis_output_file,
+        local_ais_output_file=local_ais_output_file,
+        local_wais_output_file=local_wais_output_file,
+        local_eais_output_file=local_eais_output_file,
+        input_bundle=bundle,
+        climate_cache_dir=climate_cache_dir,
+        climate_cache_max_bytes=climate_cache_max_mb * 2**20,
+        stream_chunk=stream_chunk_samples,
+        climate_format=climate_format,
+        precision=precision,
+        output_format=output_format,
+        compression=compression_policy,
+        packing=packing_policy,
+        chunking=chunk_policy,
+        fingerprint_cache_dir=fingerprint_cache_dir,
+        fingerprint_cache_max_bytes=fingerprint_cache_max_mb * 2**20,
+        max_workers=workers,
     )
+
+
+@main.command()
+@click.option(
+    "--scenarios",
+    type=str,
+    required=True,
+    help="Comma-separated list of scenarios",
+)
+@click.option(
+    "--pipeline-id",
+    type=str,
+    help="Unique identifier for this instance of the module, with '{scenario}' in place of the scenario",
+)
+@_reference_options
+@_climate_options
+@_output_options
+@_projection_options
+@_glacier_options
+@_icesheet_options
+@_localize_options
+@_branch_chunksize_option
+@click.option(
+    "--workers",
+    type=int,
+    help="Number of scenarios to run at a time, each in its own process [default: number of cores]",
+)
+@_output_file_options(_GLACIER_OUTPUT_FILES + _ICESHEET_OUTPUT_FILES, template=True)
+def batch(
+    scenarios,
+    refyear_start,
+    refyear_end,
+    start_year,
+    tlm_flag,
+    pipeline_id,
+    climate_data_file,
+    climate_cache_dir,
+    climate_cache_max_mb,
+    stream_chunk_samples,
+    climate_format,
+    precision,
+    output_format,
+    compression,
+    compression_level,
+    shuffle,
+    variable_compression_level,
+    pack,
+    pack_resolution,
+    bitround_keepbits,
+    chunk_layout,
+    chunk_shape,
+    chunk_cache_mb,
+    rng_seed,
+    pyear_start,
+    pyear_end,
+    pyear_step,
+    nmsamps,
+    ntsamps,
+    nsamps,
+    use_gmip,
+    glacier_fraction_file,
+    icesheet_fraction_file,
+    location_file,
+    chunksize,
+    fingerprint_dir,
+    input_bundle,
+    fingerprint_cache_dir,
+    fingerprint_cache_max_mb,
+    workers,
+    global_glacier_output_file,
+    local_glacier_output_file,
+    global_gis_output_file,
+    global_ais_output_file,
+    global_wais_output_file,
+    global_eais_output_file,
+    local_gis_output_file,
+    local_ais_output_file,
+    local_wais_output_file,
+    local_eais_output_file,
+):
+    """Run the glaciers and icesheets workflows for several scenarios."""
+    click.echo("Hello from ipccar5-batch!")
+
+    if fingerprint_dir is None and input_bundle is None:
+        raise click.UsageError("One of --fingerprint-dir or --input-bundle is required")
+    compression_policy = _compression_policy(
+        compression,
+        compression_level,
+        shuffle,
+        variable_compression_level,
+        output_format,
+    )
+    packing_policy = _packing_policy(pack, pack_resolution, bitround_keepbits)
+    chunk_policy = _chunk_policy(chunk_layout, chunk_shape, chunk_cache_mb)
+
+    # Only argument errors are usage errors; failures of the runs are raised as is
+    scenario_list = [x.strip() for x in scenarios.split(",") if x.strip()]
+    output_files = dict(
+        global_glacier_output_file=global_glacier_output_file,
+        local_glacier_output_file=local_glacier_output_file,
+        global_gis_output_file=global_gis_output_file,
+        global_ais_output_file=global_ais_output_file,
+        global_wais_output_file=global_wais_output_file,
+        global_eais_output_file=global_eais_output_file,
+        local_gis_output_file=local_gis_output_file,
+        local_ais_output_file=local_ais_output_file,
+        local_wais_output_file=local_wais_output_file,
+        local_eais_output_file=local_eais_output_file,
+    )
+    try:
+        check_batch_args(scenario_list, output_files)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    ar5_run_batch(
+        scenarios=scenario_list,
+        climate_fname=climate_data_file,
+        location_file=location_file,
+        fingerprint_dir=fingerprint_dir,
+        glacier_fraction_file=glacier_fraction_file,
+        input_bundle_file=input_bundle,
+        fingerprint_cache_dir=fingerprint_cache_dir,
+        fingerprint_cache_max_bytes=fingerprint_cache_max_mb * 2**20,
+        max_workers=workers,
+        refyear_start=refyear_start,
+        refyear_end=refyear_end,
+        start_year=start_year,
+        tlm_flag=tlm_flag,
+        pipeline_id=pipeline_id,
+        rng_seed=rng_seed,
+        pyear_start=pyear_start,
+        pyear_end=pyear_end,
+        pyear_step=pyear_step,
+        nmsamps=nmsamps,
+        ntsamps=ntsamps,
+        nsamps=nsamps,
+        use_gmip=use_gmip,
+        icesheet_fraction_file=icesheet_fraction_file,
+        chunksize=chunksize,
+        climate_cache_dir=climate_cache_dir,
+        climate_cache_max_bytes=climate_cache_max_mb * 2**20,
+        stream_chunk=stream_chunk_samples,
+        climate_format=climate_format,
+        precision=precision,
+        output_format=output_format,
+        compression=compression_policy,
+        packing=packing_policy,
+        chunking=chunk_policy,
+        **output_files,
+    )
+
+
+@main.command()
+@click.option(
+    "--fingerprint-dir", type=str, help="Path to fingerprint directory", required=True
+)
+@click.option(
+    "--glacier-fraction-file",
+    type=str,
+    help="Path to glacier fraction file",
+)
+@click.option(
+    "--icesheet-fraction-file",
+    type=str,
+    help="Path to icesheet fraction file",
+)
+@click.option(
+    "--location-file",
+    help="File that contains name, id, lat, and lon of points for localization",
+)
+@click.option(
+    "--output-file",
+    type=str,
+    help="Path to the input bundle to create",
+    required=True,
+)
+def bundle(
+    fingerprint_dir,
+    glacier_fraction_file,
+    icesheet_fraction_file,
+    location_file,
+    output_file,
+):
+    """Compile fingerprints, fraction tables and locations into one input bundle."""
+    WriteBundle(
+        output_file,
+        fingerprint_dir,
+        glacier_fraction_file=glacier_fraction_file,
+        icesheet_fraction_file=icesheet_fraction_file,
+        location_file=location_file,
+    )
+    logger.info("Wrote input bundle %s", output_file)
+
+
+@main.command(name="benchmark-compression")
+@click.option(
+    "--input-file",
+    type=str,
+    help="NetCDF file or Zarr store written by the workflows to benchmark on",
+    required=True,
+)
+@click.option(
+    "--codecs",
+    type=str,
+    help="Comma-separated compression codecs to try (default: all)",
+)
+@click.option(
+    "--levels",
+    default="1,4,9",
+    show_default=True,
+    type=str,
+    help="Comma-separated compression levels to try",
+)
+@click.option(
+    "--shuffle/--no-shuffle",
+    default=True,
+    show_default=True,
+    help="Apply the byte-shuffle filter before compressing",
+)
+@click.option(
+    "--output-format",
+    default="netcdf",
+    show_default=True,
+    type=click.Choice(OUTPUT_FORMATS),
+    help="Format to write",
+)
+@click.option(
+    "--tmp-dir",
+    type=str,
+    help="Directory for the temporary files (default: the system default)",
+)
+@click.option(
+    "--pack",
+    default="none",
+    show_default=True,
+    type=click.Choice(["none"] + list(PACKING_TYPES)),
+    help="Pack the sea-level change variables to integers before compressing",
+)
+@click.option(
+    "--pack-resolution",
+    default=0.1,
+    show_default=True,
+    type=float,
+    help="Largest step between packed values in mm",
+)
+@click.option(
+    "--bitround-keepbits",
+    type=int,
+    help="Bit-round the sea-level change variables to this many mantissa bits before compressing (not with --pack)",
+)
+def benchmark_compression(
+    input_file,
+    codecs,
+    levels,
+    shuffle,
+    output_format,
+    tmp_dir,
+    pack,
+    pack_resolution,
+    bitround_keepbits,
+):
+    """Report write and read speed and compression ratio of each compression codec."""
+    if codecs is not None:
+        codecs = [x.strip() for x in codecs.split(",") if x.strip()]
+        unknown = [x for x in codecs if x not in COMPRESSION_CODECS]
+        if unknown:
+            raise click.UsageError(
+                "Unknown compression codecs {0}, expected some of {1}".format(
+                    ", ".join(unknown), ", ".join(COMPRESSION_CODECS)
+                )
+            )
+    try:
+        levels = [int(x) for x in levels.split(",") if x.strip()]
+    except ValueError:
+        raise click.UsageError("--levels must be comma-separated integers")
+
+    results = BenchmarkCompression(
+        input_file,
+        codecs=codecs,
+        levels=levels,
+        shuffle=shuffle,
+        output_format=output_format,
+        tmp_dir=tmp_dir,
+        packing=_packing_policy(pack, pack_resolution, bitround_keepbits),
+    )
+
+    click.echo(
+        "{0:<12} {1:>5} {2:>8} {3:>12} {4:>7} {5:>11} {6:>10}".format(
+            "codec", "level", "shuffle", "size MB", "ratio", "write MB/s", "read MB/s"
+        )
+    )
+    for x in results:
+        if not x["available"]:
+            click.echo("{0:<12} not available in this netCDF4 build".format(x["codec"]))
+            continue
+        click.echo(
+            "{0:<12} {1:>5} {2:>8} {3:>12.2f} {4:>7.2f} {5:>11.1f} {6:>10.1f}".format(
+                x["codec"],
+                x["level"],
+                "yes" if x["shuffle"] else "no",
+                x["size"] / 1e6,
+                x["ratio"],
+                x["write_mbs"],
+                x["read_mbs"],
+            )
+        )
+
+
+def _compression_policy(codec, level, shuffle, variable_levels, output_format):
+    # Build the compression policy of the command line options
+    levels = {}
+    for item in variable_levels:
+        (name, sep, value) = item.partition("=")
+        try:
+            levels[name.strip()] = int(value)
+        except ValueError:
+            sep = ""
+        if not sep or not name.strip():
+            raise click.UsageError(
+                "--variable-compression-level must be VARIABLE=LEVEL, got {0}".format(
+                    item
+                )
+            )
+    codec = None if codec == "default" else codec
+    if codec is not None and not CodecAvailable(codec, output_format):
+        raise click.UsageError(
+            "Compression codec {0} is not available in this netCDF4 build".format(codec)
+        )
+    return CompressionPolicy(codec, level, shuffle, levels=levels)
+
+
+def _packing_policy(pack, resolution, keepbits):
+    # Build the packing policy of the command line options, if any
+    if pack == "none" and keepbits is None:
+        return None
+    try:
+        return PackingPolicy(
+            None if pack == "none" else pack, resolution, keepbits=keepbits
+        )
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+
+def _chunk_policy(layout, shape, cache_mb):
+    # Build the chunk policy of the command line options, if any
+    if layout == "default" and shape is None and cache_mb is None:
+        return None
+    chunks = {}
+    if shape is not None:
+        try:
+            sizes = [int(x) for x in shape.split(",")]
+        except ValueError:
+            sizes = []
+        if len(sizes) != 3:
+            raise click.UsageError(
+                "--chunk-shape must be SAMPLES,YEARS,LOCATIONS, got {0}".format(shape)
+            )
+        chunks = dict(zip(("samples", "years", "locations"), sizes))
+    try:
+        return ChunkPolicy(
+            None if layout == "default" else layout,
+            chunks,
+            cache_bytes=None if cache_mb is None else cache_mb * 2**20,
+        )
+    except ValueError as e:
+        raise click.UsageError(str(e))
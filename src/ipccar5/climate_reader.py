@@ -0,0 +1,138 @@
+import os
+import threading
+
+import h5py
+import netCDF4
+import zarr
+
+""" climate_reader.py
+
+Pluggable readers for the climate data file (FAIR or two-layer model output).
+
+The climate data is organized as one group per scenario, each holding variables such
+as "surface_temperature" laid out as [years, samples] from 1750 onward. The same
+layout is read from an HDF5 file (h5py), a NetCDF file (netCDF4) or a Zarr store
+(zarr).
+
+NETCDF4 files are HDF5 files and are read with h5py unless the NetCDF reader is
+asked for, which reads the same scenario groups through netCDF4. Classic NetCDF
+files (NETCDF3) cannot hold groups and are rejected.
+
+Every reader opens the data lazily and returns an object that behaves like an open
+h5py File: keys() lists the groups in sorted order (as h5py does), f[scenario][variable]
+is an array-like with shape and dtype that reads only the selection it is indexed
+with, and close() releases the file. Zarr stores are read chunk by chunk, with the chunks of a
+selection fetched concurrently. The netCDF-C library is not thread safe, so reads
+through the NetCDF reader are serialized by a lock.
+
+Readers are registered by name in CLIMATE_READERS. With climate_format="auto" a
+directory or a path ending in ".zarr" is read as a Zarr store, an HDF5 file
+(including NETCDF4 files) with h5py and anything else with netCDF4, which reports
+classic NetCDF files as unsupported.
+
+"""
+
+
+def _open_hdf5(climate_fname):
+    return h5py.File(climate_fname, "r")
+
+
+def _open_netcdf(climate_fname):
+    with _NETCDF_LOCK:
+        ds = netCDF4.Dataset(climate_fname, "r")
+        if ds.data_model != "NETCDF4":
+            ds.close()
+            raise ValueError(
+                "Climate data file {0} is a {1} file, expected a NETCDF4 file with one group per scenario".format(
+                    climate_fname, ds.data_model
+                )
+            )
+        ds.set_auto_mask(False)
+    return _NetCDFClimate(ds)
+
+
+def _open_zarr(climate_fname):
+    return _ZarrClimate(zarr.open_group(climate_fname, mode="r"))
+
+
+# Serializes calls into the netCDF-C library
+_NETCDF_LOCK = threading.Lock()
+
+# Climate readers by format name
+CLIMATE_READERS = {
+    "hdf5": _open_hdf5,
+    "netcdf": _open_netcdf,
+    "zarr": _open_zarr,
+}
+
+
+def ClimateFormat(climate_fname):
+    # Guess the format of the climate data file
+    if os.path.isdir(climate_fname) or climate_fname.rstrip("/").endswith(".zarr"):
+        return "zarr"
+    if h5py.is_hdf5(climate_fname):
+        return "hdf5"
+    return "netcdf"
+
+
+def OpenClimate(climate_fname, climate_format="auto"):
+    # Open the climate data file with the reader for its format
+    if climate_format == "auto":
+        climate_format = ClimateFormat(climate_fname)
+    try:
+        reader = CLIMATE_READERS[climate_format]
+    except KeyError:
+        raise ValueError(
+            "Unknown climate data format {0}, expected one of {1}".format(
+                climate_format, ", ".join(["auto"] + list(CLIMATE_READERS))
+            )
+        )
+    return reader(climate_fname)
+
+
+class _NetCDFClimate:
+    # h5py-like view of a netCDF4 Dataset or Group
+
+    def __init__(self, ds):
+        self.ds = ds
+
+    def keys(self):
+        return sorted(list(self.ds.groups) + list(self.ds.variables))
+
+    def __getitem__(self, name):
+        if name in self.ds.groups:
+            return _NetCDFClimate(self.ds.groups[name])
+        return _NetCDFVariable(self.ds.variables[name])
+
+    def close(self):
+        with _NETCDF_LOCK:
+            self.ds.close()
+
+
+class _NetCDFVariable:
+    # Array-like view of a netCDF4 Variable that reads under the netCDF lock
+
+    def __init__(self, var):
+        self.var = var
+        self.shape = var.shape
+        self.dtype = var.dtype
+
+    def __getitem__(self, key):
+        with _NETCDF_LOCK:
+            return self.var[key]
+
+
+class _ZarrClimate:
+    # h5py-like view of a Zarr group
+
+    def __init__(self, group):
+        self.group = group
+
+    def keys(self):
+        return sorted(self.group.keys())
+
+    def __getitem__(self, name):
+        return self.group[name]
+
+    def close(self):
+        pass
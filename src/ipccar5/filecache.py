@@ -0,0 +1,222 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+""" filecache.py
+
+Helpers for the content-addressed on-disk caches that let repeated runs skip work
+whose inputs have not changed.
+
+Entries are ".npy" files in a cache directory named by a hex key. Keys are built
+from the contents of the input files (not their paths), so a cache can be shared
+between runs, pipelines and copies of the same input data. Writes are atomic, so
+concurrent runs sharing a cache directory never see partial entries. Each kind of
+entry starts its keys with its own prefix, so caches sharing a directory are bounded
+and evicted separately.
+
+"""
+
+# Name of the file, within a cache directory, that remembers the content digests of
+# input files by path, together with their size and modification time
+DIGEST_INDEX = "digests.json"
+
+# Lock file serializing updates of the digest index between processes
+DIGEST_LOCK = "digests.lock"
+
+# Number of input paths remembered in the digest index (least recently added first
+# out)
+MAX_DIGESTS = 1024
+
+
+def file_digest(fname, cache_dir=None):
+    """
+    Return the SHA-256 hex digest of the contents of a file.
+
+    If `fname` is a directory (such as a Zarr store), the digest covers the relative
+    paths and contents of all files below it.
+
+    If `cache_dir` is given, the digest is remembered there by the real path, with a
+    stamp of the size and modification time of the file (or of all files below the
+    directory), so an unchanged input is hashed only once. A changed input replaces
+    its entry, and the index holds at most MAX_DIGESTS paths.
+    """
+    fname = os.path.realpath(fname)
+    stamp = _file_stamp(fname)
+    if cache_dir is not None:
+        entry = _read_digest_index(cache_dir).get(fname)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+
+    if os.path.isdir(fname):
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(fname):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                h.update(os.path.relpath(path, fname).encode())
+                h.update(_file_digest(path).encode())
+        digest = h.hexdigest()
+    else:
+        digest = _file_digest(fname)
+
+    if cache_dir is not None:
+        # Merge with the entries other processes have added since the index was read
+        with _digest_index_lock(cache_dir):
+            index = _read_digest_index(cache_dir)
+            index.pop(fname, None)
+            index[fname] = [stamp, digest]
+            for path in list(index)[: max(0, len(index) - MAX_DIGESTS)]:
+                del index[path]
+            atomic_write(
+                os.path.join(cache_dir, DIGEST_INDEX),
+                lambda f: f.write(json.dumps(index).encode()),
+            )
+
+    return digest
+
+
+def _file_digest(fname):
+    # Digest of the contents of one file
+    with open(fname, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _file_stamp(fname):
+    # Size and modification time of a file, or of all files below a directory
+    if not os.path.isdir(fname):
+        st = os.stat(fname)
+        return "{0}:{1}".format(st.st_size, st.st_mtime_ns)
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(fname):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            h.update(
+                "{0}:{1}:{2}\0".format(
+                    os.path.relpath(path, fname), st.st_size, st.st_mtime_ns
+                ).encode()
+            )
+    return h.hexdigest()
+
+
+def _read_digest_index(cache_dir):
+    # Digest index of a cache directory, {path: [stamp, digest]}
+    try:
+        with open(os.path.join(cache_dir, DIGEST_INDEX), "r") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(index, dict):
+        return {}
+    return {
+        path: entry
+        for path, entry in index.items()
+        if isinstance(entry, list) and len(entry) == 2
+    }
+
+
+@contextlib.contextmanager
+def _digest_index_lock(cache_dir):
+    # Exclusive lock on the digest index of a cache directory, between processes
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, DIGEST_LOCK), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def cache_key(*parts):
+    # Combine strings, numbers and numpy arrays into one hex key
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(str(part.dtype).encode())
+            h.update(str(part.shape).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(repr(part).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def load_array(cache_dir, key, mmap_mode=None):
+    """
+    Return the array cached under `key`, or None if there is no such entry.
+
+    A hit refreshes the entry's modification time, which `evict` uses to find the
+    least recently used entries; an entry that cannot be touched (read-only cache,
+    or evicted by another process since it was loaded) is still returned.
+    """
+    path = os.path.join(cache_dir, key + ".npy")
+    try:
+        arr = np.load(path, mmap_mode=mmap_mode)
+    except (OSError, ValueError):
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return arr
+
+
+def save_array(cache_dir, key, arr):
+    # Atomically store an array under key
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key + ".npy")
+    atomic_write(path, lambda f: np.save(f, arr))
+    return path
+
+
+def evict(cache_dir, max_bytes, prefix=""):
+    """
+    Delete the least recently used entries whose keys start with `prefix` until they
+    take at most `max_bytes`.
+
+    Only entries (".npy" files) are considered, so the digest index, its lock, the
+    temporary files of writes in progress and the entries of other caches sharing
+    the directory are left alone.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if (
+            entry.is_file()
+            and entry.name.startswith(prefix)
+            and entry.name.endswith(".npy")
+        ):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, entry.path))
+
+    total = sum(x[1] for x in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def atomic_write(path, writer):
+    # Write to a temporary file in the same directory and move it into place
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            writer(f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
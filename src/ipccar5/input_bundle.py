@@ -0,0 +1,210 @@
+import glob
+import json
+import mmap
+import os
+
+import numpy as np
+
+from ipccar5.AssignFP import InterpolateFields
+from ipccar5.ReadFingerprint import ReadFingerprint
+from ipccar5.read_fractionfile import ReadFractionFile
+from ipccar5.read_locationfile import ReadLocationFile
+from ipccar5.filecache import atomic_write
+
+""" input_bundle.py
+
+Compiles the static inputs of a run (the FPRINT fingerprints, the glacier and ice
+sheet fraction tables and the location list) into one versioned binary bundle, and
+reads such a bundle back as memory-mapped arrays.
+
+A bundle is a single file laid out as
+
+    magic (8 bytes) | header length (uint64, little-endian) | JSON header | arrays
+
+The header records the bundle version and the dtype, shape and byte offset of each
+array. Every array starts on a 64-byte boundary so that it can be viewed in place
+from a memory map. Reading a bundle is one open plus the pages actually touched.
+
+Arrays held in a bundle:
+fp = Fingerprints [fingerprints, lats, lons], with the latitudes sorted ascending
+fp_names = Fingerprint names (the file names without 'fprint_' and '.nc')
+fp_lats, fp_lons = Fingerprint grid
+glac_region_names, glac_frac_years, glac_frac = Glacier fraction table (optional)
+ice_region_names, ice_frac_years, ice_frac = Ice sheet fraction table (optional)
+site_names, site_ids, site_lats, site_lons = Locations (optional)
+
+"""
+
+BUNDLE_MAGIC = b"IPCCAR5B"
+BUNDLE_VERSION = 1
+BUNDLE_ALIGN = 64
+
+
+def WriteBundle(
+    bundle_file,
+    fingerprint_dir,
+    glacier_fraction_file=None,
+    icesheet_fraction_file=None,
+    location_file=None,
+):
+    arrays = {}
+
+    # Stack the fingerprints, which must all share one grid
+    fp_files = sorted(glob.glob(os.path.join(fingerprint_dir, "fprint_*.nc")))
+    if not fp_files:
+        raise ValueError("No fingerprint files found in {0}".format(fingerprint_dir))
+    fp_names = []
+    fp_fields = []
+    grid_lats = None
+    grid_lons = None
+    for fp_file in fp_files:
+        (fp, fp_lats, fp_lons) = ReadFingerprint(fp_file)
+        fp_lats = np.asarray(fp_lats, dtype=float)
+        fp_lons = np.asarray(fp_lons, dtype=float)
+        if grid_lats is None:
+            (grid_lats, grid_lons) = (fp_lats, fp_lons)
+        elif not (
+            np.array_equal(fp_lats, grid_lats) and np.array_equal(fp_lons, grid_lons)
+        ):
+            raise ValueError(
+                "Fingerprint file {0} is not on the same grid as {1}".format(
+                    fp_file, fp_files[0]
+                )
+            )
+        fp_names.append(os.path.basename(fp_file)[len("fprint_") : -len(".nc")])
+        fp_fields.append(np.ma.getdata(fp))
+
+    # Pre-sort the latitudes
+    lat_sort = np.argsort(grid_lats)
+    arrays["fp"] = np.stack(fp_fields)[:, lat_sort, :]
+    arrays["fp_names"] = np.array(fp_names)
+    arrays["fp_lats"] = grid_lats[lat_sort]
+    arrays["fp_lons"] = grid_lons
+
+    if glacier_fraction_file is not None:
+        (names, years, frac) = ReadFractionFile(glacier_fraction_file)
+        arrays["glac_region_names"] = np.array(names)
+        arrays["glac_frac_years"] = years
+        arrays["glac_frac"] = frac
+
+    if icesheet_fraction_file is not None:
+        (names, years, frac) = ReadFractionFile(icesheet_fraction_file)
+        arrays["ice_region_names"] = np.array(names)
+        arrays["ice_frac_years"] = years
+        arrays["ice_frac"] = frac
+
+    if location_file is not None:
+        (names, ids, lats, lons) = ReadLocationFile(location_file)
+        arrays["site_names"] = names
+        arrays["site_ids"] = ids
+        arrays["site_lats"] = lats
+        arrays["site_lons"] = lons
+
+    # Lay out the arrays after the header
+    header = {"version": BUNDLE_VERSION, "arrays": {}}
+    offset = 0
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        arrays[name] = arr
+        header["arrays"][name] = {
+            "dtype": arr.dtype.str,
+            "shape": list(arr.shape),
+            "offset": offset,
+        }
+        offset += _aligned(arr.nbytes)
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = _aligned(len(BUNDLE_MAGIC) + 8 + len(header_bytes))
+
+    def write(f):
+        f.write(BUNDLE_MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, arr in arrays.items():
+            f.seek(data_start + header["arrays"][name]["offset"])
+            f.write(arr.tobytes())
+        f.truncate(data_start + offset)
+
+    atomic_write(os.path.abspath(bundle_file), write)
+
+    return bundle_file
+
+
+def ReadBundle(bundle_file):
+    # Memory-map the bundle and return its arrays in a dictionary
+    with open(bundle_file, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mm[: len(BUNDLE_MAGIC)] != BUNDLE_MAGIC:
+        raise ValueError("{0} is not an ipccar5 input bundle".format(bundle_file))
+    header_len = int(np.frombuffer(mm, dtype="<u8", count=1, offset=8)[0])
+    header = json.loads(mm[16 : 16 + header_len].decode("utf-8"))
+    if header["version"] != BUNDLE_VERSION:
+        raise ValueError(
+            "Input bundle {0} has version {1}, expected version {2}".format(
+                bundle_file, header["version"], BUNDLE_VERSION
+            )
+        )
+    data_start = _aligned(16 + header_len)
+
+    bundle = {"file": bundle_file, "version": header["version"]}
+    for name, info in header["arrays"].items():
+        dtype = np.dtype(info["dtype"])
+        count = int(np.prod(info["shape"]))
+        bundle[name] = np.frombuffer(
+            mm, dtype=dtype, count=count, offset=data_start + info["offset"]
+        ).reshape(info["shape"])
+
+    return bundle
+
+
+def BundleFingerprints(bundle, names, qlats, qlons):
+    # Interpolate the named fingerprints of a bundle to the sites [names, sites]
+    fp_names = list(bundle["fp_names"])
+    missing = [name for name in names if name not in fp_names]
+    if missing:
+        raise ValueError(
+            "Fingerprints {0} not found in input bundle {1}".format(
+                missing, bundle["file"]
+            )
+        )
+
+    # Read and interpolate each distinct fingerprint once
+    unique_names = list(dict.fromkeys(names))
+    fields = bundle["fp"][[fp_names.index(name) for name in unique_names]]
+    values = InterpolateFields(
+        bundle["fp_lats"], bundle["fp_lons"], fields, qlats, qlons
+    )
+
+    return values[[unique_names.index(name) for name in names]]
+
+
+def BundleFractions(bundle, component):
+    # Return (region_names, frac_years, frac) for the "glac" or "ice" fraction table
+    if component + "_frac" not in bundle:
+        raise ValueError(
+            "Input bundle {0} has no {1} fraction table".format(
+                bundle["file"], component
+            )
+        )
+    return (
+        list(bundle[component + "_region_names"]),
+        np.array(bundle[component + "_frac_years"]),
+        np.array(bundle[component + "_frac"]),
+    )
+
+
+def BundleLocations(bundle):
+    # Return (names, ids, lats, lons) of the locations in a bundle
+    if "site_ids" not in bundle:
+        raise ValueError("Input bundle {0} has no locations".format(bundle["file"]))
+    return (
+        bundle["site_names"],
+        bundle["site_ids"],
+        bundle["site_lats"],
+        bundle["site_lons"],
+    )
+
+
+def _aligned(nbytes):
+    # Round a byte count up to the array alignment
+    return -(-nbytes // BUNDLE_ALIGN) * BUNDLE_ALIGN
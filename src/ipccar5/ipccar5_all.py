@@ -0,0 +1,428 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from ipccar5.ipccar5_glaciers_preprocess import ar5_preprocess_glaciers
+from ipccar5.ipccar5_glaciers_fit import ar5_fit_glaciers
+from ipccar5.ipccar5_glaciers_project import ar5_project_glaciers
+from ipccar5.ipccar5_glaciers_postprocess import ar5_postprocess_glaciers
+
+from ipccar5.ipccar5_icesheets_fit import ar5_fit_icesheets
+from ipccar5.ipccar5_icesheets_project import ar5_project_icesheets
+from ipccar5.ipccar5_icesheets_postprocess import ar5_postprocess_icesheets
+
+from ipccar5.AssignFP import AssignFPs, CACHE_MAX_BYTES
+from ipccar5.preprocess_cache import (
+    CACHE_MAX_BYTES as PREPROCESS_CACHE_MAX_BYTES,
+    preprocess_end_year,
+)
+from ipccar5.Import2lmData import OpenClimateFile
+from ipccar5.read_locationfile import ReadLocationFile
+from ipccar5.read_fractionfile import ReadFractionFile
+from ipccar5.input_bundle import (
+    BundleFingerprints,
+    BundleFractions,
+    BundleLocations,
+    ReadBundle,
+)
+
+""" ipccar5_all.py
+
+Runs the glaciers and ice sheets workflows together. The climate data is preprocessed
+once, over the years both need, the locations are loaded once and the fingerprints of
+the glacier regions and ice sheets are interpolated to them in one batch. The glacier
+and ice sheet branches run concurrently when more than one core is available. The
+outputs are the same as those of the separate glaciers and icesheets commands with
+the same settings.
+
+Parameters:
+The parameters of ar5_preprocess_glaciers, ar5_project_glaciers,
+ar5_project_icesheets and the postprocess functions, with the glacier output files
+named global_glacier_output_file and local_glacier_output_file
+chunksize = Number of locations to process at a time in both postprocess stages, or
+            None for the default of each (GLACIER_CHUNKSIZE, ICESHEET_CHUNKSIZE)
+climate_cache_max_bytes = Size bound of the preprocess entries of the climate cache
+                          (see preprocess_cache.py)
+max_workers = Number of branches to run at a time (default: 2 if more than one core
+              is available, otherwise 1)
+locations = Optional (names, ids, lats, lons) of the sites, already loaded
+fingerprints = Optional dictionary of fingerprints at the sites, already
+               interpolated, by name (glacier region, "gis", "wais" and "eais")
+stream_chunk = Optional number of samples per chunk of the streaming preprocess
+               (see stream_preprocess.py)
+climate_format = Format of the climate data file (see climate_reader.py)
+precision = Floating point type of the sample arrays, "float64" or "float32"
+output_format = Format of the output files, "netcdf" or "zarr" (see write_output.py)
+compression = Optional compression policy of the output files (see write_output.py)
+packing = Optional packing policy of the output files (see write_output.py)
+chunking = Optional chunk policy of the local output files (see write_output.py)
+
+ar5_run_batch() runs ar5_run_all() for several scenarios on a process pool. The
+locations are loaded and the fingerprints interpolated once for all scenarios, each
+worker process keeps the climate file open across the scenarios it runs, and the
+output file names are templates in which "{scenario}" is replaced by the scenario.
+
+"""
+
+# Number of locations processed at a time by the glacier and ice sheet postprocess
+# stages, unless given
+GLACIER_CHUNKSIZE = 20
+ICESHEET_CHUNKSIZE = 50
+
+# Output file arguments of ar5_run_all, which ar5_run_batch formats per scenario
+OUTPUT_FILE_ARGS = (
+    "global_glacier_output_file",
+    "local_glacier_output_file",
+    "global_gis_output_file",
+    "global_ais_output_file",
+    "global_wais_output_file",
+    "global_eais_output_file",
+    "local_gis_output_file",
+    "local_ais_output_file",
+    "local_wais_output_file",
+    "local_eais_output_file",
+)
+
+# Input bundle of a batch worker process
+_worker_bundle = None
+
+
+def ar5_run_all(
+    scenario,
+    refyear_start,
+    refyear_end,
+    start_year,
+    tlm_flag,
+    pipeline_id,
+    climate_fname,
+    rng_seed,
+    pyear_start,
+    pyear_end,
+    pyear_step,
+    nmsamps,
+    ntsamps,
+    nsamps,
+    use_gmip,
+    glacier_fraction_file,
+    icesheet_fraction_file,
+    location_file,
+    chunksize,
+    fingerprint_dir,
+    global_glacier_output_file,
+    local_glacier_output_file,
+    global_gis_output_file,
+    global_ais_output_file,
+    global_wais_output_file,
+    global_eais_output_file,
+    local_gis_output_file,
+    local_ais_output_file,
+    local_wais_output_file,
+    local_eais_output_file,
+    input_bundle=None,
+    climate_cache_dir=None,
+    climate_cache_max_bytes=PREPROCESS_CACHE_MAX_BYTES,
+    fingerprint_cache_dir=None,
+    fingerprint_cache_max_bytes=CACHE_MAX_BYTES,
+    max_workers=None,
+    locations=None,
+    fingerprints=None,
+    stream_chunk=None,
+    climate_format="auto",
+    precision="float64",
+    output_format="netcdf",
+    compression=None,
+    packing=None,
+    chunking=None,
+):
+    if max_workers is None:
+        max_workers = 2 if (os.cpu_count() or 1) > 1 else 1
+
+    # Preprocess the climate data once, up to the end of the projection and at least
+    # to 2100 where the ice-sheet dynamics ranges are defined. The glacier and ice
+    # sheet preprocess stages are identical for the same years.
+    preprocess_dict = ar5_preprocess_glaciers(
+        scenario,
+        refyear_start,
+        refyear_end,
+        start_year,
+        preprocess_end_year(pyear_end),
+        tlm_flag,
+        pipeline_id,
+        climate_fname=climate_fname,
+        cache_dir=climate_cache_dir,
+        cache_max_bytes=climate_cache_max_bytes,
+        stream_chunk=stream_chunk,
+        climate_format=climate_format,
+        precision=precision,
+    )
+
+    # Number of locations each postprocess stage processes at a time
+    if chunksize is None:
+        (glacier_chunksize, icesheet_chunksize) = (
+            GLACIER_CHUNKSIZE,
+            ICESHEET_CHUNKSIZE,
+        )
+    else:
+        (glacier_chunksize, icesheet_chunksize) = (chunksize, chunksize)
+
+    # Load the site locations once for both postprocess stages
+    if locations is None:
+        locations = load_locations(location_file, input_bundle)
+
+    def project_glaciers():
+        fit_dict = ar5_fit_glaciers(
+            start_year=start_year, use_gmip=use_gmip, pipeline_id=pipeline_id
+        )
+        return ar5_project_glaciers(
+            preprocess_dict=preprocess_dict,
+            fit_dict=fit_dict,
+            rng_seed=rng_seed,
+            pyear_start=pyear_start,
+            pyear_end=pyear_end,
+            pyear_step=pyear_step,
+            nmsamps=nmsamps,
+            ntsamps=ntsamps,
+            nsamps=nsamps,
+            pipeline_id=pipeline_id,
+            glacier_fraction_file=glacier_fraction_file,
+            global_output_file=global_glacier_output_file,
+            input_bundle=input_bundle,
+            output_format=output_format,
+            compression=compression,
+            packing=packing,
+        )
+
+    def project_icesheets():
+        fit_dict = ar5_fit_icesheets(
+            preprocess_dict=preprocess_dict, pipeline_id=pipeline_id
+        )
+        return ar5_project_icesheets(
+            rng_seed=rng_seed,
+            pyear_start=pyear_start,
+            pyear_end=pyear_end,
+            pyear_step=pyear_step,
+            cyear_start=pyear_start,
+            cyear_end=pyear_end,
+            nmsamps=nmsamps,
+            ntsamps=ntsamps,
+            nsamps=nsamps,
+            pipeline_id=pipeline_id,
+            preprocess_dict=preprocess_dict,
+            fit_dict=fit_dict,
+            icesheet_fraction_file=icesheet_fraction_file,
+            global_gis_output_file=global_gis_output_file,
+            global_ais_output_file=global_ais_output_file,
+            global_wais_output_file=global_wais_output_file,
+            global_eais_output_file=global_eais_output_file,
+            input_bundle=input_bundle,
+            output_format=output_format,
+            compression=compression,
+            packing=packing,
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # Run the glacier and ice sheet projections
+        glaciers_future = pool.submit(project_glaciers)
+        icesheets_future = pool.submit(project_icesheets)
+        glaciers_project_dict = glaciers_future.result()
+        icesheets_project_dict = icesheets_future.result()
+
+        # Interpolate the fingerprints of all glacier regions and ice sheets in one batch
+        fp_names = list(glaciers_project_dict["glac_region_names"]) + [
+            "gis",
+            "wais",
+            "eais",
+        ]
+        if fingerprints is None:
+            fps = interpolate_fingerprints(
+                fp_names,
+                locations,
+                fingerprint_dir,
+                input_bundle,
+                fingerprint_cache_dir,
+                fingerprint_cache_max_bytes,
+            )
+        else:
+            fps = np.stack([fingerprints[name] for name in fp_names])
+        nregions = len(fp_names) - 3
+
+        # Localize the glacier and ice sheet projections
+        glaciers_future = pool.submit(
+            ar5_postprocess_glaciers,
+            locationfile=location_file,
+            chunksize=glacier_chunksize,
+            pipeline_id=pipeline_id,
+            project_dict=glaciers_project_dict,
+            preprocess_dict=preprocess_dict,
+            fingerprint_dir=fingerprint_dir,
+            local_output_file=local_glacier_output_file,
+            locations=locations,
+            fingerprints=fps[:nregions],
+            output_format=output_format,
+            compression=compression,
+            packing=packing,
+            chunking=chunking,
+        )
+        icesheets_future = pool.submit(
+            ar5_postprocess_icesheets,
+            preprocess_dict=preprocess_dict,
+            project_dict=icesheets_project_dict,
+            pipeline_id=pipeline_id,
+            locationfile=location_file,
+            chunksize=icesheet_chunksize,
+            fingerprint_dir=fingerprint_dir,
+            local_gis_output_file=local_gis_output_file,
+            local_ais_output_file=local_ais_output_file,
+            local_wais_output_file=local_wais_output_file,
+            local_eais_output_file=local_eais_output_file,
+            locations=locations,
+            fingerprints=fps[nregions:],
+            output_format=output_format,
+            compression=compression,
+            packing=packing,
+            chunking=chunking,
+        )
+        glaciers_future.result()
+        icesheets_future.result()
+
+    return (glaciers_project_dict, icesheets_project_dict)
+
+
+def ar5_run_batch(
+    scenarios,
+    climate_fname,
+    location_file,
+    fingerprint_dir,
+    glacier_fraction_file,
+    input_bundle_file=None,
+    fingerprint_cache_dir=None,
+    fingerprint_cache_max_bytes=CACHE_MAX_BYTES,
+    max_workers=None,
+    **kwargs,
+):
+    check_batch_args(scenarios, kwargs)
+
+    # Load the locations and interpolate the fingerprints once for all scenarios
+    input_bundle = ReadBundle(input_bundle_file) if input_bundle_file else None
+    locations = load_locations(location_file, input_bundle)
+    if glacier_fraction_file is None and input_bundle is not None:
+        glac_region_names = BundleFractions(input_bundle, "glac")[0]
+    else:
+        glac_region_names = ReadFractionFile(glacier_fraction_file)[0]
+    fp_names = list(dict.fromkeys(glac_region_names)) + ["gis", "wais", "eais"]
+    fps = interpolate_fingerprints(
+        fp_names,
+        locations,
+        fingerprint_dir,
+        input_bundle,
+        fingerprint_cache_dir,
+        fingerprint_cache_max_bytes,
+    )
+    fingerprints = dict(zip(fp_names, fps))
+    locations = tuple(np.asarray(x) for x in locations)
+
+    # Run the scenarios, one per worker process at a time
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_batch_worker,
+        initargs=(
+            climate_fname,
+            kwargs.get("climate_format", "auto"),
+            input_bundle_file,
+        ),
+    ) as pool:
+        futures = [
+            pool.submit(
+                _run_batch_scenario,
+                scenario,
+                dict(
+                    kwargs,
+                    climate_fname=climate_fname,
+                    location_file=location_file,
+                    fingerprint_dir=fingerprint_dir,
+                    glacier_fraction_file=glacier_fraction_file,
+                ),
+                locations,
+                fingerprints,
+            )
+            for scenario in scenarios
+        ]
+        for future in futures:
+            future.result()
+
+    return None
+
+
+def check_batch_args(scenarios, kwargs):
+    # Check the arguments of ar5_run_batch before any scenario is run
+    if not scenarios:
+        raise ValueError("At least one scenario is required")
+
+    # Every scenario needs its own output files
+    for arg in OUTPUT_FILE_ARGS:
+        if (
+            len(scenarios) > 1
+            and kwargs.get(arg) is not None
+            and "{scenario}" not in kwargs[arg]
+        ):
+            raise ValueError(
+                "{0} must contain '{{scenario}}' to run several scenarios".format(arg)
+            )
+
+
+def load_locations(location_file, input_bundle=None):
+    # Return (names, ids, lats, lons) from the location file or the input bundle
+    if location_file is None and input_bundle is not None:
+        return BundleLocations(input_bundle)
+    return ReadLocationFile(location_file)
+
+
+def interpolate_fingerprints(
+    fp_names,
+    locations,
+    fingerprint_dir,
+    input_bundle=None,
+    fingerprint_cache_dir=None,
+    fingerprint_cache_max_bytes=CACHE_MAX_BYTES,
+):
+    # Interpolate the named fingerprints to the locations in one batch [names, sites]
+    (_, _, site_lats, site_lons) = locations
+    if fingerprint_dir is None and input_bundle is not None:
+        return BundleFingerprints(input_bundle, fp_names, site_lats, site_lons)
+    return AssignFPs(
+        [
+            os.path.join(fingerprint_dir, "fprint_{0}.nc".format(name))
+            for name in fp_names
+        ],
+        site_lats,
+        site_lons,
+        cache_dir=fingerprint_cache_dir,
+        cache_max_bytes=fingerprint_cache_max_bytes,
+    )
+
+
+def _init_batch_worker(climate_fname, climate_format, input_bundle_file):
+    # Keep the climate file and the input bundle open for the life of the worker
+    global _worker_bundle
+    OpenClimateFile(climate_fname, climate_format)
+    if input_bundle_file:
+        _worker_bundle = ReadBundle(input_bundle_file)
+
+
+def _run_batch_scenario(scenario, kwargs, locations, fingerprints):
+    # Run ar5_run_all for one scenario of a batch, in a worker process
+    kwargs = dict(kwargs)
+    # Substitute the scenario alone, leaving any other braces in the names as they are
+    for arg in OUTPUT_FILE_ARGS + ("pipeline_id",):
+        if kwargs.get(arg) is not None:
+            kwargs[arg] = kwargs[arg].replace("{scenario}", scenario)
+
+    return ar5_run_all(
+        scenario=scenario,
+        input_bundle=_worker_bundle,
+        max_workers=1,
+        locations=locations,
+        fingerprints=fingerprints,
+        **kwargs,
+    )
@@ -2,8 +2,10 @@ import numpy as np
 import os
 import time
 import argparse
-from ipccar5.AssignFP import AssignFP
+from ipccar5.AssignFP import AssignFPs, CACHE_MAX_BYTES
 from ipccar5.read_locationfile import ReadLocationFile
+from ipccar5.input_bundle import BundleFingerprints, BundleLocations
+from ipccar5.write_output import WriteOutput
 
 import xarray as xr
 import dask.array as da
@@ -15,8 +17,19 @@ This script runs the glacier post-processing task for the AR5 Glaciers workflow.
 Parameters:
 locationfile = File that contains points for localization
 pipeline_id = Unique identifier for the pipeline running this code
-
-Output: NetCDF file containing local contributions from GIC
+fingerprint_cache_dir = Optional directory of the persistent fingerprint cache
+fingerprint_cache_max_bytes = Size bound of the fingerprint cache
+input_bundle = Optional input bundle (see input_bundle.py) supplying the locations
+               and fingerprints when locationfile or fingerprint_dir is not given
+locations = Optional (names, ids, lats, lons) of the sites, already loaded
+fingerprints = Optional fingerprints of the glacier regions at the sites, already
+               interpolated [regions, sites]
+output_format = Format of the output file, "netcdf" or "zarr" (see write_output.py)
+compression = Optional compression policy of the output file (see write_output.py)
+packing = Optional packing policy of the output file (see write_output.py)
+chunking = Optional chunk policy of the output file (see write_output.py)
+
+Output: NetCDF file (or Zarr store) containing local contributions from GIC
 
 """
 
@@ -29,9 +42,19 @@ def ar5_postprocess_glaciers(
     preprocess_dict,
     fingerprint_dir,
     local_output_file=None,
+    fingerprint_cache_dir=None,
+    fingerprint_cache_max_bytes=CACHE_MAX_BYTES,
+    input_bundle=None,
+    locations=None,
+    fingerprints=None,
+    output_format="netcdf",
+    compression=None,
+    packing=None,
+    chunking=None,
 ):
     # Extract the projection data from the file
-    gicsamps = project_dict["gicsamps"]
+    glac_samps = project_dict["glac_samps"]
+    glac_frac = project_dict["glac_frac"]
     glac_region_names = project_dict["glac_region_names"]
     targyears = project_dict["data_years"]
 
@@ -48,31 +71,53 @@ def ar5_postprocess_glaciers(
 
     # Load the site locations
     # locationfile = os.path.join(os.path.dirname(__file__), locationfilename)
-    (_, site_ids, site_lats, site_lons) = ReadLocationFile(locationfile)
-
-    # Initialize variable to hold the localized projections
-    (nsamps, nregions, nyears) = gicsamps.shape
+    if locations is not None:
+        (_, site_ids, site_lats, site_lons) = locations
+    elif locationfile is None and input_bundle is not None:
+        (_, site_ids, site_lats, site_lons) = BundleLocations(input_bundle)
+    else:
+        (_, site_ids, site_lats, site_lons) = ReadLocationFile(locationfile)
+
+    # Get some dimension data from the loaded data structures
+    (nsamps, nyears) = glac_samps.shape
+    nregions = glac_frac.shape[0]
     nsites = len(site_ids)
-    # local_sl = da.array(np.full((nsamps, nyears, nsites), 0.0))
-    # local_sl = local_sl.rechunk((-1,-1,chunksize))
-    local_sl = da.zeros((nsamps, nyears, nsites), chunks=(-1, -1, chunksize))
-
-    # Loop through the GIC regions
-    for i in np.arange(0, nregions):
-        # Get the fingerprint file name for this region
-        thisRegion = glac_region_names[i]
-
-        # Get the fingerprints for these sites from this region
-        regionfile = os.path.join(fingerprint_dir, "fprint_{0}.nc".format(thisRegion))
 
-        regionfp = da.from_array(
-            AssignFP(regionfile, site_lats, site_lons), chunks=chunksize
+    # Get the fingerprints for these sites from each GIC region [regions, sites]
+    if fingerprints is not None:
+        regionfps = fingerprints
+    elif fingerprint_dir is None and input_bundle is not None:
+        regionfps = BundleFingerprints(
+            input_bundle, glac_region_names, site_lats, site_lons
         )
-        # regionfp = regionfp.rechunk(chunksize)
+    else:
+        # Get the fingerprint file names for the GIC regions
+        regionfiles = [
+            os.path.join(fingerprint_dir, "fprint_{0}.nc".format(thisRegion))
+            for thisRegion in glac_region_names
+        ]
+        regionfps = AssignFPs(
+            regionfiles,
+            site_lats,
+            site_lons,
+            cache_dir=fingerprint_cache_dir,
+            cache_max_bytes=fingerprint_cache_max_bytes,
+        )
+
+    # The regional fractions do not depend on the sample, so the sum over regions of
+    # (samples x fraction) outer fingerprint collapses to the global samples times one
+    # [years, sites] factor, computed here with a single small matrix product and
+    # applied in the precision of the projections
+    local_factor = da.from_array(
+        (glac_frac.T @ regionfps).astype(glac_samps.dtype, copy=False),
+        chunks=(-1, chunksize),
+    )
 
-        # Multiply the fingerprints and the projections and add them to the running total
-        # over the regions
-        local_sl += np.multiply.outer(gicsamps[:, i, :], regionfp)
+    # Apply the factor to the global projections in a single pass [samples, years, sites]
+    local_sl = (
+        da.from_array(glac_samps, chunks=(-1, -1))[:, :, np.newaxis]
+        * local_factor[np.newaxis, :, :]
+    )
 
     # Define the missing value for the netCDF files
     nc_missing_value = np.nan  # np.iinfo(np.int16).min
@@ -105,16 +150,19 @@ def ar5_postprocess_glaciers(
     )
 
     if local_output_file:
-        glac_out.to_netcdf(
+        WriteOutput(
+            glac_out,
             local_output_file,
             encoding={
                 "sea_level_change": {
                     "dtype": "f4",
-                    "zlib": True,
-                    "complevel": 4,
                     "_FillValue": nc_missing_value,
                 }
             },
+            output_format=output_format,
+            compression=compression,
+            packing=packing,
+            chunking=chunking,
         )
 
     return None
@@ -4,7 +4,19 @@
 
 import argparse
 import numpy as np
-from ipccar5.Import2lmData import Import2lmData, Filter2lmData
+from ipccar5.Import2lmData import (
+    Import2lmData,
+    Filter2lmData,
+    Unique2lmSamples,
+    Integrate2lmSamples,
+)
+from ipccar5.stream_preprocess import StreamPreprocess
+from ipccar5.preprocess_cache import (
+    CACHE_MAX_BYTES,
+    preprocess_key,
+    load_preprocess,
+    save_preprocess,
+)
 import logging
 
 
@@ -25,9 +37,51 @@ def ar5_preprocess_glaciers(
     tlm_flag,
     pipeline_id,
     climate_fname,
+    cache_dir=None,
+    cache_max_bytes=CACHE_MAX_BYTES,
+    stream_chunk=None,
+    climate_format="auto",
+    precision="float64",
 ):
     # Define the input data directory
 
+    # Load the preprocessed data from the cache if it is there
+    if cache_dir is not None:
+        cache_key = preprocess_key(
+            cache_dir,
+            climate_fname,
+            scenario,
+            refyear_start,
+            refyear_end,
+            start_year,
+            end_year,
+            precision,
+        )
+        cached = load_preprocess(cache_dir, cache_key)
+        if cached is not None:
+            logging.info("Preprocess loaded from cache.")
+            return {**cached, "startyr": start_year, "scenario": scenario}
+
+    # Stream through the climate file in chunks of stream_chunk samples, keeping the
+    # sample arrays on disk, if requested
+    if stream_chunk is not None:
+        output = StreamPreprocess(
+            climate_fname,
+            scenario,
+            refyear_start,
+            refyear_end,
+            start_year,
+            end_year,
+            chunk_samples=stream_chunk,
+            climate_format=climate_format,
+            dtype=np.dtype(precision),
+        )
+        output["startyr"] = start_year
+        output["scenario"] = scenario
+        if cache_dir is not None:
+            save_preprocess(cache_dir, cache_key, output, cache_max_bytes)
+        return output
+
     # Load the two-layer model data
     # if tlm_flag:  # may want to take out tlm_flag since it must be 1?
     # Import the data
@@ -38,6 +92,11 @@ def ar5_preprocess_glaciers(
         refyear_start=refyear_start,  # was 1986,
         refyear_end=refyear_end,  # was 2005,
         climate_fname=climate_fname,
+        year_start=start_year,
+        year_end=end_year - 1,
+        cache_dir=cache_dir,
+        climate_format=climate_format,
+        dtype=np.dtype(precision),
     )
     # Filter the data for the appropriate years
     filtered_data_dict = Filter2lmData(
@@ -48,13 +107,17 @@ def ar5_preprocess_glaciers(
     data_years = filtered_data_dict["years"]
 
     # FOR THE TEMPORARY 2LM DATA ONLY - USES ONLY 44 UNIQUE TRAJECTORIES
-    # Find the unique temperature trajectories
+    # Find the unique temperature trajectories. If some of the samples repeat, only
+    # the unique trajectories and the map from samples to them are passed on, so the
+    # project stages evaluate their deterministic terms once per trajectory and
+    # expand them to the samples where they use them.
     # temp_samples = np.unique(filtered_data_dict["samples"], axis=0)
     temp_samples = filtered_data_dict["samples"]
+    (temp_unique, sample_map) = Unique2lmSamples(temp_samples)
 
     # Find the mean and sd of the ensemble
-    temp_mean = np.nanmean(temp_samples, axis=0)
-    temp_sd = np.nanstd(temp_samples, axis=0)
+    temp_mean = np.nanmean(temp_samples, axis=0, dtype=np.float64)
+    temp_sd = np.nanstd(temp_samples, axis=0, dtype=np.float64)
     # else:
     # Define the input data files
     # temp_mean_filename = "{0}_temperature_mean.nc".format(scenario)
@@ -85,7 +148,10 @@ def ar5_preprocess_glaciers(
     inttemp_mean = np.cumsum(temp_mean)
     # inttemp_sd = np.sqrt(np.cumsum(temp_sd**2))  # Fix the bug
     inttemp_sd = np.cumsum(temp_sd)  # Replicate the bug
-    inttemp_samples = np.cumsum(temp_samples, axis=1)
+    if sample_map is None:
+        inttemp_samples = Integrate2lmSamples(temp_samples)
+    else:
+        inttemp_unique = Integrate2lmSamples(temp_unique)
 
     # Store preprocessed data in pickles
     output = {
@@ -96,9 +162,18 @@ def ar5_preprocess_glaciers(
         "data_years": data_years,
         "startyr": start_year,
         "scenario": scenario,
-        "temp_samples": temp_samples,
-        "inttemp_samples": inttemp_samples,
     }
+    if sample_map is None:
+        output["temp_samples"] = temp_samples
+        output["inttemp_samples"] = inttemp_samples
+    else:
+        output["temp_unique"] = temp_unique
+        output["inttemp_unique"] = inttemp_unique
+        output["sample_map"] = sample_map
+
+    # Store the preprocessed data for the next run
+    if cache_dir is not None:
+        save_preprocess(cache_dir, cache_key, output, cache_max_bytes)
     logging.info("Preprocess complete.")
     return output
 
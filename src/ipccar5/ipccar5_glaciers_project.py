@@ -4,8 +4,10 @@
 import numpy as np
 import argparse
 import time
-import re
 import xarray as xr
+from ipccar5.read_fractionfile import ReadFractionFile
+from ipccar5.input_bundle import BundleFractions
+from ipccar5.write_output import WriteOutput
 
 
 class ProjectionError(Exception):
@@ -19,6 +21,99 @@ def project_glacier1(it, factor, exponent):
     return scale * factor * (it**exponent)
 
 
+def assign_glacier_methods(samps_per_model, rng):
+    """
+    Randomly partition the samples among the glacier methods.
+
+    Parameters
+    ----------
+    samps_per_model : array-like
+        Number of samples to assign to each glacier method. The counts do not need to
+        be equal; the total defines the number of samples.
+    rng : numpy.random.Generator
+        Random number generator used to draw the partition.
+
+    Returns
+    -------
+    list of numpy.ndarray
+        One block of sample indices per glacier method, in the order of
+        `samps_per_model`. The blocks are contiguous slices (views) of a single
+        permutation of ``np.arange(sum(samps_per_model))``, so together they assign
+        every sample to exactly one method.
+
+    Notes
+    -----
+    The partition is drawn with one call to ``rng.permutation`` and costs O(nsamps),
+    independent of the number of methods.
+    """
+    order = rng.permutation(int(np.sum(samps_per_model)))
+    bounds = np.concatenate(([0], np.cumsum(samps_per_model)))
+
+    return [order[bounds[i] : bounds[i + 1]] for i in range(len(samps_per_model))]
+
+
+def project_glacier_method(
+    inttemp_samples, sample_idx, year_idx, mgl, gmethod, rng, sample_map=None
+):
+    """
+    Project all samples assigned to one glacier method in a single array operation.
+
+    Parameters
+    ----------
+    inttemp_samples : array-like
+        Integrated temperature samples, shape (samples, data years).
+    sample_idx : array-like
+        Indices of the samples (rows of `inttemp_samples`) assigned to this method.
+    year_idx : array-like
+        Boolean mask or indices selecting the target years from the data years.
+    mgl : numpy.ndarray
+        Projection of this method using the ensemble-mean integrated temperature,
+        shape (target years,).
+    gmethod : dict
+        Calibration of this method with keys 'factor', 'exponent' and 'cvgl'.
+    rng : numpy.random.Generator
+        Random number generator used for the methodological noise.
+    sample_map : array-like, optional
+        Row of `inttemp_samples` holding the trajectory of each sample. If given,
+        `inttemp_samples` holds the unique trajectories, and the glacier power law is
+        evaluated once per trajectory used by this method; by default sample i is
+        row i.
+
+    Returns
+    -------
+    numpy.ndarray
+        Glacier projections in m SLE, shape (len(sample_idx), target years).
+
+    Notes
+    -----
+    The methodological noise is drawn as one vector of ``len(sample_idx)`` standard
+    normal numbers, the i-th of which is applied to ``sample_idx[i]``. A
+    `numpy.random.Generator` produces the same stream for one draw of size n as for n
+    draws of size 1, so for a given seed the output is identical to projecting the
+    samples one at a time in the order of `sample_idx`.
+    """
+    if sample_map is None:
+        zgl = project_glacier1(
+            inttemp_samples[np.ix_(sample_idx, year_idx)],
+            gmethod["factor"],
+            gmethod["exponent"],
+        )
+    else:
+        # Project each trajectory once and expand the projections to the samples
+        (rows, row_idx) = np.unique(sample_map[sample_idx], return_inverse=True)
+        zgl = project_glacier1(
+            inttemp_samples[np.ix_(rows, year_idx)],
+            gmethod["factor"],
+            gmethod["exponent"],
+        )[row_idx]
+
+    # add normally distributed methodological uncertainty based on ensemble-mean integrated temperature
+    noise = rng.standard_normal(len(sample_idx))
+    zgl += mgl[np.newaxis, :] * noise[:, np.newaxis] * gmethod["cvgl"]
+
+    return zgl
+
+
 def ar5_project_glaciers(
     preprocess_dict,
     fit_dict,
@@ -32,6 +127,10 @@ def ar5_project_glaciers(
     pipeline_id,
     glacier_fraction_file,
     global_output_file,
+    input_bundle=None,
+    output_format="netcdf",
+    compression=None,
+    packing=None,
 ):
     # Define the target years
     # Creates an array from pyear_start to pyear_end in steps of pyear_steps to serve as the projection window
@@ -55,9 +154,16 @@ def ar5_project_glaciers(
     baseyear = preprocess_dict["startyr"]
     scenario = preprocess_dict["scenario"]
     # temp_samples = preprocess_dict["temp_samples"]  # Added for Fair Correlation  Issue
-    inttemp_samples = preprocess_dict[
-        "inttemp_samples"
-    ]  # Added for Fair Correlation  Issue
+
+    # Integrated temperature samples, or if samples repeat the unique trajectories
+    # and the trajectory of each sample
+    sample_map = preprocess_dict.get("sample_map")
+    if sample_map is None:
+        inttemp_samples = preprocess_dict[
+            "inttemp_samples"
+        ]  # Added for Fair Correlation  Issue
+    else:
+        inttemp_samples = preprocess_dict["inttemp_unique"]
 
     # Load the fit data
     # data_file = "{}_fit.pkl".format(pipeline_id)
@@ -122,8 +228,9 @@ def ar5_project_glaciers(
     # Generate samples for methodologies
     r = rng.standard_normal(nr)
 
-    # Initialize the data structure to hold the glacier samples
-    total_glac_samps = np.full((nsamps, nyr), np.nan)
+    # Initialize the data structure to hold the glacier samples, in the precision of
+    # the temperature samples
+    total_glac_samps = np.full((nsamps, nyr), np.nan, dtype=inttemp_samples.dtype)
 
     # Takes the data years and divides by the number of glacier methods to evenly distribute methods across
     # temp_samples and inttemp_samples
@@ -131,36 +238,29 @@ def ar5_project_glaciers(
     remainder_samps = nsamps % ngl
     samps_per_model[rng.choice(ngl, size=remainder_samps, replace=False)] += 1
 
-    # Creates a list of integers for the random method selection
-    time_series_idx = np.arange(nsamps)
+    # Randomly partition the time-series indices among the glacier methods
+    method_sample_idx = assign_glacier_methods(samps_per_model, rng)
 
     for method_idx in range(len(samps_per_model)):
         # Applies the method index to the select the appropriate glacier method
         gmethod = glparm[method_idx]
 
-        # Randomly pulls time-series indices from the selection pool corresponding to samps_per_model for this method
-        rnd_sample_idx = rng.choice(
-            time_series_idx, size=samps_per_model[method_idx], replace=False
-        )
-
-        # Removes the selected time-series indices from the selection pool for the next loop
-        time_series_idx = np.setdiff1d(time_series_idx, rnd_sample_idx)
+        # Time-series indices assigned to this method
+        rnd_sample_idx = method_sample_idx[method_idx]
 
         # glacier projection for this method using the mean temperature timeseries
         mgl = project_glacier1(inttemp_mean, gmethod["factor"], gmethod["exponent"])
 
-        for sample_idx in rnd_sample_idx:
-            # Project time series of total glacier loss based on integrated temperature time series
-            zgl = project_glacier1(
-                inttemp_samples[sample_idx][year_idx],
-                gmethod["factor"],
-                gmethod["exponent"],
-            )
-
-            # add normally distributed methodological uncertainty based on ensemble-mean integrated temperature
-            zgl = zgl + (mgl * rng.standard_normal(1) * gmethod["cvgl"])
-
-            total_glac_samps[sample_idx, :] = zgl
+        # Project time series of total glacier loss for all samples of this method at once
+        total_glac_samps[rnd_sample_idx, :] = project_glacier_method(
+            inttemp_samples,
+            rnd_sample_idx,
+            year_idx,
+            mgl,
+            gmethod,
+            rng,
+            sample_map=sample_map,
+        )
 
     total_glac_samps += dmz
     total_glac_samps[total_glac_samps > glmass] = glmass
@@ -196,12 +296,12 @@ def ar5_project_glaciers(
         },
     )
     ds["sea_level_change"] = ds["sea_level_change"].astype("float32")
-    ds.to_netcdf(
+    WriteOutput(
+        ds,
         global_output_file,
-        mode="w",
-        format="NETCDF4",
-        engine="netcdf4",
-        encoding={"sea_level_change": {"zlib": True, "complevel": 4}},
+        output_format=output_format,
+        compression=compression,
+        packing=packing,
     )
 
     # Load in the glacier fraction data-------------------------------------------
@@ -209,48 +309,27 @@ def ar5_project_glaciers(
     # is not represented and region 7 is represented twice.  I'm not sure why, but
     # it's consistent with the K14 workflow, so it's been carried over to this.
 
-    # Initialize the data structures
-    glac_frac = []
-    glac_region_names = []
-
-    # Open the glacier fraction file
-    # glac_frac_file = os.path.join(os.path.dirname(__file__), "glacier_fraction.txt")
-    with open(glacier_fraction_file, "r") as fp:
-        # Get the fraction years from the header line
-        header_items = re.split(",\s*", fp.readline())
-        glac_frac_years = np.array([int(x) for x in header_items[1:]])
-
-        # Read in the rest of the files
-        for line in fp:
-            line = line.rstrip()
-
-            # Split the line into the region name and the fractions then append to data structures
-            line_parts = re.split(",\s*", line)
-            glac_region_names.append(line_parts[0])
-            glac_frac.append([float(x) for x in line_parts[1:]])
-
-    # Convert the fraction data structure into a numpy array
-    glac_frac = np.array(glac_frac)
+    # Read the glacier fraction file, or take the fractions from the input bundle
+    if glacier_fraction_file is None and input_bundle is not None:
+        (glac_region_names, glac_frac_years, glac_frac) = BundleFractions(
+            input_bundle, "glac"
+        )
+    else:
+        (glac_region_names, glac_frac_years, glac_frac) = ReadFractionFile(
+            glacier_fraction_file
+        )
 
     # Subset the fraction data to the years of interest
     year_idx = np.isin(glac_frac_years, data_years)
     glac_frac = glac_frac[:, year_idx]
 
-    # Reshape the samples and fraction data structures for broadcasting
-    glac_frac = glac_frac[np.newaxis, :, :]
-
-    # Apply the regional fractions to the global projections
-
-    total_glac_samps = total_glac_samps[:, :, np.newaxis]
-    total_glac_samps = np.transpose(total_glac_samps, (0, 2, 1))
-
-    gicsamps = total_glac_samps * glac_frac
-
-    # print(gicsamps.shape)
-
-    # Save the global glacier and ice caps projections to a pickle
+    # Return the projections in factorized form. The regional fractions are the same
+    # for every sample, so the regional projections (samples, regions, years) are
+    # the global samples times the (regions, years) fraction table and are never
+    # materialized here.
     output = {
-        "gicsamps": gicsamps,
+        "glac_samps": total_glac_samps,
+        "glac_frac": glac_frac,
         "glac_region_names": glac_region_names,
         "data_years": data_years,
     }
@@ -3,7 +3,9 @@ import os
 import time
 import argparse
 from ipccar5.read_locationfile import ReadLocationFile
-from ipccar5.AssignFP import AssignFP
+from ipccar5.AssignFP import AssignFPs, CACHE_MAX_BYTES
+from ipccar5.input_bundle import BundleFingerprints, BundleLocations
+from ipccar5.write_output import ComputeWrites, PackingRanges, WriteOutput
 
 import xarray as xr
 import dask.array as da
@@ -19,8 +21,19 @@ to local sea-level rise
 Parameters:
 locationfile = File that contains points for localization
 pipeline_id = Unique identifer for the pipeline running this code
-
-Output: NetCDF file containing local contributions from ice sheets
+fingerprint_cache_dir = Optional directory of the persistent fingerprint cache
+fingerprint_cache_max_bytes = Size bound of the fingerprint cache
+input_bundle = Optional input bundle (see input_bundle.py) supplying the locations
+               and fingerprints when locationfile or fingerprint_dir is not given
+locations = Optional (names, ids, lats, lons) of the sites, already loaded
+fingerprints = Optional GIS, WAIS and EAIS fingerprints at the sites, already
+               interpolated [3, sites]
+output_format = Format of the output files, "netcdf" or "zarr" (see write_output.py)
+compression = Optional compression policy of the output files (see write_output.py)
+packing = Optional packing policy of the output files (see write_output.py)
+chunking = Optional chunk policy of the output files (see write_output.py)
+
+Output: NetCDF files (or Zarr stores) containing local contributions from ice sheets
 
 """
 
@@ -36,6 +49,15 @@ def ar5_postprocess_icesheets(
     local_ais_output_file,
     local_wais_output_file,
     local_eais_output_file,
+    fingerprint_cache_dir=None,
+    fingerprint_cache_max_bytes=CACHE_MAX_BYTES,
+    input_bundle=None,
+    locations=None,
+    fingerprints=None,
+    output_format="netcdf",
+    compression=None,
+    packing=None,
+    chunking=None,
 ):
     # Read in the global projection data
     # projfile = "{}_projections.pkl".format(pipeline_id)
@@ -69,7 +91,12 @@ def ar5_postprocess_icesheets(
 
     # Load the site locations
     # locationfile = os.path.join(os.path.dirname(__file__), locationfilename)
-    (_, site_ids, site_lats, site_lons) = ReadLocationFile(locationfile)
+    if locations is not None:
+        (_, site_ids, site_lats, site_lons) = locations
+    elif locationfile is None and input_bundle is not None:
+        (_, site_ids, site_lats, site_lons) = BundleLocations(input_bundle)
+    else:
+        (_, site_ids, site_lats, site_lons) = ReadLocationFile(locationfile)
 
     # Get some dimension data from the loaded data structures
     nsamps = gissamps.shape[0]
@@ -78,15 +105,26 @@ def ar5_postprocess_icesheets(
 
     # Get the fingerprints for all sites from all ice sheets
     # fpdir = os.path.join(os.path.dirname(__file__), "FPRINT")
-    gisfp = da.array(
-        AssignFP(os.path.join(fingerprint_dir, "fprint_gis.nc"), site_lats, site_lons)
-    )
-    waisfp = da.array(
-        AssignFP(os.path.join(fingerprint_dir, "fprint_wais.nc"), site_lats, site_lons)
-    )
-    eaisfp = da.array(
-        AssignFP(os.path.join(fingerprint_dir, "fprint_eais.nc"), site_lats, site_lons)
-    )
+    if fingerprints is not None:
+        icesheetfps = fingerprints
+    elif fingerprint_dir is None and input_bundle is not None:
+        icesheetfps = BundleFingerprints(
+            input_bundle, ["gis", "wais", "eais"], site_lats, site_lons
+        )
+    else:
+        icesheetfps = AssignFPs(
+            [
+                os.path.join(fingerprint_dir, "fprint_gis.nc"),
+                os.path.join(fingerprint_dir, "fprint_wais.nc"),
+                os.path.join(fingerprint_dir, "fprint_eais.nc"),
+            ],
+            site_lats,
+            site_lons,
+            cache_dir=fingerprint_cache_dir,
+            cache_max_bytes=fingerprint_cache_max_bytes,
+        )
+    # Apply the fingerprints in the precision of the projections
+    (gisfp, waisfp, eaisfp) = da.array(np.asarray(icesheetfps, dtype=gissamps.dtype))
 
     # Rechunk the fingerprints for memory
     gisfp = gisfp.rechunk(chunksize)
@@ -185,52 +223,80 @@ def ar5_postprocess_icesheets(
         attrs=ncvar_attributes,
     )
 
-    # Write the netcdf output files
+    # Valid ranges of the packed outputs, reduced together in one computation
+    (gis_ranges, wais_ranges, eais_ranges, ais_ranges) = PackingRanges(
+        [gis_out, wais_out, eais_out, ais_out], packing
+    )
+
+    # Write the netcdf output files. The writes are only set up here and then run
+    # together in one computation, so the WAIS and EAIS chunks are computed once for
+    # their own files and the AIS total, and each chunk is released as soon as all
+    # the files that need it have been written.
     # gis_out.to_netcdf("{0}_{1}_localsl.nc".format(pipeline_id, "GIS"), encoding={"sea_level_change": {"dtype": "f4", "zlib": True, "complevel":4, "_FillValue": nc_missing_value}})
-    gis_out.to_netcdf(
+    gis_write = WriteOutput(
+        gis_out,
         local_gis_output_file,
+        output_format=output_format,
+        compression=compression,
+        packing=packing,
+        chunking=chunking,
+        packing_ranges=gis_ranges,
+        compute=False,
         encoding={
             "sea_level_change": {
                 "dtype": "f4",
-                "zlib": True,
-                "complevel": 4,
                 "_FillValue": nc_missing_value,
             }
         },
     )
 
     # wais_out.to_netcdf("{0}_{1}_localsl.nc".format(pipeline_id, "WAIS"), encoding={"sea_level_change": {"dtype": "f4", "zlib": True, "complevel":4, "_FillValue": nc_missing_value}})
-    wais_out.to_netcdf(
+    wais_write = WriteOutput(
+        wais_out,
         local_wais_output_file,
+        output_format=output_format,
+        compression=compression,
+        packing=packing,
+        chunking=chunking,
+        packing_ranges=wais_ranges,
+        compute=False,
         encoding={
             "sea_level_change": {
                 "dtype": "f4",
-                "zlib": True,
-                "complevel": 4,
                 "_FillValue": nc_missing_value,
             }
         },
     )
 
     # eais_out.to_netcdf("{0}_{1}_localsl.nc".format(pipeline_id, "EAIS"), encoding={"sea_level_change": {"dtype": "f4", "zlib": True, "complevel":4, "_FillValue": nc_missing_value}})
-    eais_out.to_netcdf(
+    eais_write = WriteOutput(
+        eais_out,
         local_eais_output_file,
+        output_format=output_format,
+        compression=compression,
+        packing=packing,
+        chunking=chunking,
+        packing_ranges=eais_ranges,
+        compute=False,
         encoding={
             "sea_level_change": {
                 "dtype": "f4",
-                "zlib": True,
-                "complevel": 4,
                 "_FillValue": nc_missing_value,
             }
         },
     )
-    ais_out.to_netcdf(
+    ais_write = WriteOutput(
+        ais_out,
         local_ais_output_file,
+        output_format=output_format,
+        compression=compression,
+        packing=packing,
+        chunking=chunking,
+        packing_ranges=ais_ranges,
+        compute=False,
         encoding={
             "sea_level_change": {
                 "dtype": "f4",
-                "zlib": True,
-                "complevel": 4,
                 "_FillValue": nc_missing_value,
             }
         },
@@ -238,6 +304,9 @@ def ar5_postprocess_icesheets(
 
     # ais_out.to_netcdf("{0}_{1}_localsl.nc".format(pipeline_id, "AIS"), encoding={"sea_level_change": {"dtype": "f4", "zlib": True, "complevel":4, "_FillValue": nc_missing_value}})
 
+    # Compute the localized projections and write all four files in one pass
+    ComputeWrites([gis_write, wais_write, eais_write, ais_write], output_format)
+
     return None
 
 
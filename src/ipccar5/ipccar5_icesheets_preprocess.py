@@ -5,7 +5,19 @@
 import os
 import argparse
 import numpy as np
-from ipccar5.Import2lmData import Import2lmData, Filter2lmData
+from ipccar5.Import2lmData import (
+    Import2lmData,
+    Filter2lmData,
+    Unique2lmSamples,
+    Integrate2lmSamples,
+)
+from ipccar5.stream_preprocess import StreamPreprocess
+from ipccar5.preprocess_cache import (
+    CACHE_MAX_BYTES,
+    preprocess_key,
+    load_preprocess,
+    save_preprocess,
+)
 
 
 class ProjectionError(Exception):
@@ -17,11 +29,59 @@ def endofhistory():
 
 
 def ar5_preprocess_icesheets(
-    scenario, startyr, tlm_flag, pipeline_id, climate_fname, refyear_start, refyear_end
+    scenario,
+    startyr,
+    tlm_flag,
+    pipeline_id,
+    climate_fname,
+    refyear_start,
+    refyear_end,
+    endyr=2301,
+    cache_dir=None,
+    cache_max_bytes=CACHE_MAX_BYTES,
+    stream_chunk=None,
+    climate_format="auto",
+    precision="float64",
 ):
     # Define the input data directory
     indir = os.path.dirname(__file__)
 
+    # Load the preprocessed data from the cache if it is there
+    if cache_dir is not None:
+        cache_key = preprocess_key(
+            cache_dir,
+            climate_fname,
+            scenario,
+            refyear_start,
+            refyear_end,
+            startyr,
+            endyr,
+            precision,
+        )
+        cached = load_preprocess(cache_dir, cache_key)
+        if cached is not None:
+            return {**cached, "startyr": startyr, "scenario": scenario}
+
+    # Stream through the climate file in chunks of stream_chunk samples, keeping the
+    # sample arrays on disk, if requested
+    if stream_chunk is not None:
+        output = StreamPreprocess(
+            climate_fname,
+            scenario,
+            refyear_start,
+            refyear_end,
+            startyr,
+            endyr,
+            chunk_samples=stream_chunk,
+            climate_format=climate_format,
+            dtype=np.dtype(precision),
+        )
+        output["startyr"] = startyr
+        output["scenario"] = scenario
+        if cache_dir is not None:
+            save_preprocess(cache_dir, cache_key, output, cache_max_bytes)
+        return output
+
     # Load the two-layer model data
     # if tlm_flag:
 
@@ -33,22 +93,34 @@ def ar5_preprocess_icesheets(
         refyear_start=refyear_start,  # 1986,
         refyear_end=refyear_end,  # 2005,
         climate_fname=climate_fname,
+        year_start=startyr,
+        year_end=endyr - 1,
+        cache_dir=cache_dir,
+        climate_format=climate_format,
+        dtype=np.dtype(precision),
     )
 
     # Filter the data for the appropriate years
-    filtered_data_dict = Filter2lmData(tlm_dict, filter_years=np.arange(startyr, 2301))
+    filtered_data_dict = Filter2lmData(
+        tlm_dict,
+        filter_years=np.arange(startyr, endyr),  # was 2301
+    )
 
     # Extract the years
     data_years = filtered_data_dict["years"]
 
     # FOR THE TEMPORARY 2LM DATA ONLY - USES ONLY 44 UNIQUE TRAJECTORIES
-    # Find the unique temperature trajectories
+    # Find the unique temperature trajectories. If some of the samples repeat, only
+    # the unique trajectories and the map from samples to them are passed on, so the
+    # project stages evaluate their deterministic terms once per trajectory and
+    # expand them to the samples where they use them.
     # temp_samples = np.unique(filtered_data_dict["samples"], axis=0)
     temp_samples = filtered_data_dict["samples"]
+    (temp_unique, sample_map) = Unique2lmSamples(temp_samples)
 
     # Find the mean and sd of the ensemble
-    temp_mean = np.nanmean(temp_samples, axis=0)
-    temp_sd = np.nanstd(temp_samples, axis=0)
+    temp_mean = np.nanmean(temp_samples, axis=0, dtype=np.float64)
+    temp_sd = np.nanstd(temp_samples, axis=0, dtype=np.float64)
 
     # else:
 
@@ -79,7 +151,10 @@ def ar5_preprocess_icesheets(
     inttemp_mean = np.cumsum(temp_mean)
     # inttemp_sd = np.sqrt(np.cumsum(temp_sd**2))  # Fix the bug
     inttemp_sd = np.cumsum(temp_sd)  # Replicate the bug
-    inttemp_samples = np.cumsum(temp_samples, axis=1)
+    if sample_map is None:
+        inttemp_samples = Integrate2lmSamples(temp_samples)
+    else:
+        inttemp_unique = Integrate2lmSamples(temp_unique)
 
     # Store preprocessed data in pickles
     output = {
@@ -90,9 +165,18 @@ def ar5_preprocess_icesheets(
         "data_years": data_years,
         "startyr": startyr,
         "scenario": scenario,
-        "temp_samples": temp_samples,
-        "inttemp_samples": inttemp_samples,
     }
+    if sample_map is None:
+        output["temp_samples"] = temp_samples
+        output["inttemp_samples"] = inttemp_samples
+    else:
+        output["temp_unique"] = temp_unique
+        output["inttemp_unique"] = inttemp_unique
+        output["sample_map"] = sample_map
+
+    # Store the preprocessed data for the next run
+    if cache_dir is not None:
+        save_preprocess(cache_dir, cache_key, output, cache_max_bytes)
 
     return output
 
@@ -4,8 +4,10 @@
 import numpy as np
 import argparse
 import time
-import re
 import xarray as xr
+from ipccar5.read_fractionfile import ReadFractionFile
+from ipccar5.input_bundle import BundleFractions
+from ipccar5.write_output import WriteOutput
 # from netCDF4 import Dataset
 
 
@@ -13,7 +15,9 @@ class ProjectionError(Exception):
     pass
 
 
-def project_greensmb(zt, fit_dict, nt, rng):
+def project_greensmb(
+    zt, fit_dict, nt, rng, year_idx=None, blocksize=10000, sample_map=None
+):
     # Extract relevant parameters from the fit dictionary
     dtgreen = fit_dict["dtgreen"]
     fnlogsd = fit_dict["fnlogsd"]
@@ -29,10 +33,37 @@ def project_greensmb(zt, fit_dict, nt, rng):
     fe = rng.choice(nt) * (febound[1] - febound[0]) + febound[0]
     ff = fn * fe
 
-    ztgreen = zt - dtgreen
-    greensmbrate = fettweis(ztgreen, mSLEoGt)[:, :] * ff[:, np.newaxis]
+    # Years to return. The SMB rate is integrated over the full record, but only
+    # these years of the integral are kept.
+    if year_idx is None:
+        year_idx = np.arange(zt.shape[1])
+
+    # If zt holds the unique temperature trajectories, with sample_map giving the
+    # trajectory of each sample, integrate the SMB rate once per trajectory and
+    # apply the sample factors after expanding it to the samples (the factors are
+    # constant in time, so they can be taken out of the integral)
+    if sample_map is not None:
+        greensmb = np.empty((zt.shape[0], len(year_idx)), dtype=zt.dtype)
+        for start in np.arange(0, zt.shape[0], blocksize):
+            block = slice(start, start + blocksize)
+            greensmbrate = integrate_rate(fettweis(zt[block] - dtgreen, mSLEoGt))
+            greensmb[block] = greensmbrate[:, year_idx]
+        greensmb = greensmb[sample_map[:nt]]
+        greensmb *= ff[:, np.newaxis]
+        greensmb += (1 - fgreendyn) * dgreen
+        return greensmb
+
+    # Integrate the SMB rate in blocks of samples so that the full-record
+    # temporaries never exceed blocksize x years
+    greensmb = np.empty((nt, len(year_idx)), dtype=zt.dtype)
+    for start in np.arange(0, nt, blocksize):
+        block = slice(start, start + blocksize)
+        ztgreen = zt[block] - dtgreen
+        greensmbrate = fettweis(ztgreen, mSLEoGt)
+        greensmbrate *= ff[block, np.newaxis]
+        greensmbrate = integrate_rate(greensmbrate)
+        greensmb[block] = greensmbrate[:, year_idx]
 
-    greensmb = np.cumsum(greensmbrate, axis=1)[:]
     greensmb += (1 - fgreendyn) * dgreen
     # print(greensmb.shape)
 
@@ -40,17 +71,31 @@ def project_greensmb(zt, fit_dict, nt, rng):
     return greensmb
 
 
+def integrate_rate(rate):
+    # Integrate a [samples, years] rate over the years with a double precision
+    # accumulator, in place if the rate is double precision already
+    if rate.dtype == np.float64:
+        return np.cumsum(rate, axis=1, out=rate)
+    return np.cumsum(rate, axis=1, dtype=np.float64)
+
+
 def fettweis(ztgreen, mSLEoGt):
     # Greenland SMB in m yr-1 SLE from global mean temperature anomaly
     # using Eq 2 of Fettweis et al. (2013)
     return (71.5 * ztgreen + 20.4 * (ztgreen**2) + 2.8 * (ztgreen**3)) * mSLEoGt
 
 
-def project_antsmb(zit, fit_dict, nr, nt, rng, fraction=None):
+def project_antsmb(
+    zit, fit_dict, nr, nt, rng, fraction=None, year_idx=None, sample_map=None
+):
     # Return projection of Antarctic SMB contribution as a cf.Field
     # zit -- cf.Field, ensemble of time-integral temperature anomaly timeseries
     # template -- cf.Field with the required shape of the output
     # fraction -- array-like, random numbers for the SMB-dynamic feedback
+    # year_idx -- array-like, optional, indices of the years of zit to project,
+    # by default all years
+    # sample_map -- array-like, optional, row of zit holding the trajectory of each
+    # sample if zit holds the unique trajectories, by default sample i is row i
 
     # Extract relevant parameters from the fit dictionary
     pcoK = fit_dict["pcoK"]
@@ -70,16 +115,30 @@ def project_antsmb(zit, fit_dict, nr, nt, rng, fraction=None):
     elif fraction.size != nr * nt:
         raise ProjectionError("Project antsmb: fraction is the wrong size")
     else:
-        fraction.shape = (nr, nt, 1)
+        fraction = fraction.reshape(nr, nt, 1)
 
     ainterfactor = 1 - fraction * smax
 
-    antsmb = moaoKg * ainterfactor * zit.reshape(1, nt, -1)
+    # The projection scales the integrated temperature year by year, so it only needs
+    # to be evaluated at the requested years
+    if year_idx is not None:
+        zit = zit[:, year_idx]
+
+    # Expand the unique trajectories to the samples
+    if sample_map is not None:
+        zit = zit[sample_map]
+
+    # The random factors are applied in the precision of the temperature samples
+    antsmb = (moaoKg * ainterfactor).astype(zit.dtype, copy=False) * zit.reshape(
+        1, nt, -1
+    )
 
     return antsmb
 
 
-def project_greendyn(fit_dict, nm, nt, rng, data_years):
+def project_greendyn(
+    fit_dict, nm, nt, rng, data_years, eval_years=None, dtype=np.float64
+):
     # Extract relevant parameters from the fit dictionary
     fgreendyn = fit_dict["fgreendyn"]
     dgreen = fit_dict["dgreen"]
@@ -89,13 +148,30 @@ def project_greendyn(fit_dict, nm, nt, rng, data_years):
     gdyn_startratepm = 0.17 * fgreendyn
 
     gdyn_timeprojection = time_projection(
-        gdyn_startratemean, gdyn_startratepm, gdyn_finalrange, nm, nt, data_years, rng
+        gdyn_startratemean,
+        gdyn_startratepm,
+        gdyn_finalrange,
+        nm,
+        nt,
+        data_years,
+        rng,
+        eval_years=eval_years,
+        dtype=dtype,
     )
 
     return gdyn_timeprojection + fgreendyn * dgreen
 
 
-def project_antdyn(fit_dict, nm, nt, data_years, rng, fraction=None):
+def project_antdyn(
+    fit_dict,
+    nm,
+    nt,
+    data_years,
+    rng,
+    fraction=None,
+    eval_years=None,
+    dtype=np.float64,
+):
     # Extract relevant parameters from the fit dictionary
     dant = fit_dict["dant"]
     adyn_startratemean = fit_dict["adyn_startratemean"]
@@ -111,6 +187,8 @@ def project_antdyn(fit_dict, nm, nt, data_years, rng, fraction=None):
         data_years,
         rng,
         fraction=fraction,
+        eval_years=eval_years,
+        dtype=dtype,
     )
 
     return adyn_timeprojection + dant
@@ -126,6 +204,8 @@ def time_projection(
     rng,
     nfinal=1,
     fraction=None,
+    eval_years=None,
+    dtype=np.float64,
 ):
     # Return projection of a quantity which is a quadratic function of time
     # startratemean, startratepm -- rate of GMSLR at the start in mm yr-1, whose
@@ -135,12 +215,16 @@ def time_projection(
     # a time-mean; by default 1 => finalrange is the value for the last year
     # fraction -- array-like, optional, random numbers in the range 0 to 1,
     # by default uniformly distributed
+    # eval_years -- array-like, optional, subset of data_years at which to evaluate
+    # the projection, by default all of data_years. The projection is closed-form in
+    # elapsed time, so only these years are computed.
+    # dtype -- optional, type of the returned projection, by default float64
 
     if fraction is None:
         fraction = rng.random([nr, nt, 1])
     elif fraction.size != nr * nt:
         raise ProjectionError("Time Projection: fraction is the wrong size")
-    fraction = fraction.reshape(nr, nt, 1)
+    fraction = fraction.reshape(nr, nt, 1).astype(dtype, copy=False)
 
     # Number of years
     # nyr = len(data_years)
@@ -160,13 +244,16 @@ def time_projection(
     ).mean()
 
     # Create a field of elapsed time in years
-    time = data_years
-    time = time - time[0] + 1  # years since start
+    time = data_years if eval_years is None else np.asarray(eval_years)
+    time = time - data_years[0] + 1  # years since start
 
     # Calculate two-element list containing fields of the minimum and maximum
     # timeseries of projections, then calculate random ensemble within envelope
     range = [
-        float(acceleration[i]) * (time**2) + float(startrate[i]) * time for i in [0, 1]
+        (float(acceleration[i]) * (time**2) + float(startrate[i]) * time).astype(
+            dtype, copy=False
+        )
+        for i in [0, 1]
     ]
 
     projection = range[0] * (1 - fraction) + range[1] * fraction
@@ -174,7 +261,51 @@ def time_projection(
     return projection
 
 
-def ExtrapolateRate(sample, targyears, cyear_start, cyear_end):
+def interp_last_axis(x, xp, fp):
+    # Linearly interpolate every series along the last axis of fp at the single point x,
+    # matching np.interp (values beyond the ends of xp are clamped to the end values)
+    if x <= xp[0]:
+        return fp[..., 0].copy()
+    if x >= xp[-1]:
+        return fp[..., -1].copy()
+    j = np.searchsorted(xp, x, side="right") - 1
+    slope = (fp[..., j + 1] - fp[..., j]) / (xp[j + 1] - xp[j])
+    return slope * (x - xp[j]) + fp[..., j]
+
+
+def finalize_component(component, base_col, ntarg):
+    # Center a projected component [samples, needed years] in m to the base year
+    # column and convert it to mm in place, then return the target year columns
+    component = component.reshape(-1, component.shape[-1])
+    if len(base_col) > 0:
+        component -= component[:, base_col]
+    component *= 1000.0  # Convert to mm
+
+    return component[:, :ntarg]
+
+
+def ExtrapolateRate(samples, targyears, cyear_start, cyear_end):
+    """
+    Extrapolate projections beyond a constant-rate window, in place.
+
+    Parameters
+    ----------
+    samples : numpy.ndarray
+        Projections with the target years along the last axis, e.g. (samples, years)
+        for one component or (components, samples, years) for several. A 1-D array
+        holding a single time series is also accepted.
+    targyears : array-like
+        Target years corresponding to the last axis of `samples`.
+    cyear_start, cyear_end : int or None
+        Years bounding the window over which the rate is calculated. If only one is
+        provided, the window is taken to be 20 years long.
+
+    Returns
+    -------
+    numpy.ndarray
+        `samples`, where every value at or after `cyear_end` has been replaced by the
+        value at `cyear_end` plus the window rate times the years elapsed since then.
+    """
     # If only one of the constant rate years is provided, imply the other
     if cyear_start and not cyear_end:
         cyear_end = cyear_start + 20
@@ -182,20 +313,20 @@ def ExtrapolateRate(sample, targyears, cyear_start, cyear_end):
         cyear_start = cyear_end - 20
 
     # Find the start and end projection values for the rate calculation
-    proj_start = np.interp(cyear_start, targyears, sample)
-    proj_end = np.interp(cyear_end, targyears, sample)
+    proj_start = interp_last_axis(cyear_start, targyears, samples)
+    proj_end = interp_last_axis(cyear_end, targyears, samples)
 
     # Calculate the rate
     rate = (proj_end - proj_start) / (cyear_end - cyear_start)
 
     # Make a new projection
-    ext_sample = sample
-    ext_sample[targyears >= cyear_end] = proj_end + (
-        rate * (targyears[targyears >= cyear_end] - cyear_end)
+    ext_idx = targyears >= cyear_end
+    samples[..., ext_idx] = proj_end[..., np.newaxis] + (
+        rate[..., np.newaxis] * (targyears[ext_idx] - cyear_end)
     )
 
-    # Return this sample
-    return ext_sample
+    # Return the extrapolated samples
+    return samples
 
 
 def ar5_project_icesheets(
@@ -216,6 +347,10 @@ def ar5_project_icesheets(
     global_ais_output_file,
     global_wais_output_file,
     global_eais_output_file,
+    input_bundle=None,
+    output_format="netcdf",
+    compression=None,
+    packing=None,
 ):
     # Define the target years
     targyears = np.arange(pyear_start, pyear_end + 1, pyear_step)
@@ -231,8 +366,6 @@ def ar5_project_icesheets(
     # my_data = pickle.load(f)
     # f.close()
 
-    temp_samples = preprocess_dict["temp_samples"]
-    inttemp_samples = preprocess_dict["inttemp_samples"]
     temp_mean = preprocess_dict["temp_mean"]
     temp_sd = preprocess_dict["temp_sd"]
     inttemp_mean = preprocess_dict["inttemp_mean"]
@@ -241,6 +374,16 @@ def ar5_project_icesheets(
     startyr = preprocess_dict["startyr"]
     scenario = preprocess_dict["scenario"]
 
+    # Temperature samples, or if samples repeat the unique trajectories and the
+    # trajectory of each sample
+    sample_map = preprocess_dict.get("sample_map")
+    if sample_map is None:
+        temp_samples = preprocess_dict["temp_samples"]
+        inttemp_samples = preprocess_dict["inttemp_samples"]
+    else:
+        temp_samples = preprocess_dict["temp_unique"]
+        inttemp_samples = preprocess_dict["inttemp_unique"]
+
     # Load the fit data
     # data_file = "{}_fit.pkl".format(pipeline_id)
     # try:
@@ -263,66 +406,82 @@ def ar5_project_icesheets(
         ntsamps = nmsamps
 
     # Generate perfectly correlated samples
+    # Note - The resampled ensembles (mean + standard deviation * normal random number)
+    # are not used by the projections below, which work from the temperature samples
+    # directly, so they are no longer built. The draw is kept so that the random
+    # number stream, and hence the output for a given seed, is unchanged.
     z = rng.standard_normal(ntsamps)[:, np.newaxis]
 
-    # For each quantity, mean + standard deviation * normal random number
-    # NEEDS TO BE FIXED TO USE SAMPS RATHER THAN RESANMPLING
-    zt = temp_mean + (temp_sd * z)
-    zit = inttemp_mean + (inttemp_sd * z)
-
     # Number of realizations
     nr = nmsamps
 
     # Number of years in the data record
     nyr = len(data_years)
 
+    # Data years needed by the projections: the target years first, followed by the
+    # base year used for centering if it is not a target year itself
+    targyear_idx = np.flatnonzero(np.isin(data_years, targyears))
+    baseyear_idx = np.flatnonzero(data_years == startyr)
+    eval_idx = np.concatenate((targyear_idx, np.setdiff1d(baseyear_idx, targyear_idx)))
+    ntarg = len(targyear_idx)
+    base_col = np.flatnonzero(np.isin(eval_idx, baseyear_idx))
+
     # correlation between antsmb and antdyn
     # fraction=rng.random(nmsamps * ntsamps)
     fraction = rng.random(nsamps)
 
-    # Project the SMB and Dynamics portions of each ice sheet
-    greensmb = project_greensmb(temp_samples, fit_dict, nsamps, rng)
-    greendyn = project_greendyn(fit_dict, 1, nsamps, rng, data_years)
+    # Project the SMB and Dynamics portions of each ice sheet at the needed years,
+    # then center them to the baseyear and convert them to mm in place. Only the
+    # Greenland SMB integrates over the full record; the other components are
+    # evaluated at the needed years alone. All components are computed in the
+    # precision of the temperature samples.
+    greensmb = project_greensmb(
+        temp_samples, fit_dict, nsamps, rng, year_idx=eval_idx, sample_map=sample_map
+    )
+    greensmb = finalize_component(greensmb, base_col, ntarg)
+
+    greendyn = project_greendyn(
+        fit_dict,
+        1,
+        nsamps,
+        rng,
+        data_years,
+        eval_years=data_years[eval_idx],
+        dtype=temp_samples.dtype,
+    )
+    greendyn = finalize_component(greendyn, base_col, ntarg)
+
     antsmb = project_antsmb(
-        inttemp_samples, fit_dict, 1, nsamps, rng, fraction=fraction
+        inttemp_samples,
+        fit_dict,
+        1,
+        nsamps,
+        rng,
+        fraction=fraction,
+        year_idx=eval_idx,
+        sample_map=sample_map,
     )
-    antdyn = project_antdyn(fit_dict, 1, nsamps, data_years, rng, fraction=fraction)
+    antsmb = finalize_component(antsmb, base_col, ntarg)
 
-    # Center the projections to the baseyear
-    baseyear_idx = np.flatnonzero(data_years == startyr)
-    if len(baseyear_idx) > 0:
-        greensmb = greensmb - greensmb[:, baseyear_idx]
-        greendyn = greendyn - greendyn[:, :, baseyear_idx]
-        antsmb = antsmb - antsmb[:, :, baseyear_idx]
-        antdyn = antdyn - antdyn[:, :, baseyear_idx]
+    antdyn = project_antdyn(
+        fit_dict,
+        1,
+        nsamps,
+        data_years,
+        rng,
+        fraction=fraction,
+        eval_years=data_years[eval_idx],
+        dtype=temp_samples.dtype,
+    )
+    antdyn = finalize_component(antdyn, base_col, ntarg)
 
     # Reduce the years to just the target years
-    year_idx = np.isin(data_years, targyears)
-    data_years = data_years[year_idx]
-    greensmb = greensmb[:, year_idx]
-    greendyn = greendyn[:, :, year_idx]
-    antsmb = antsmb[:, :, year_idx]
-    antdyn = antdyn[:, :, year_idx]
-
-    # Flatten the ice sheet samples
-    greensmb = greensmb.reshape(-1, greensmb.shape[-1])
-    greendyn = greendyn.reshape(-1, greendyn.shape[-1])
-    antsmb = antsmb.reshape(-1, antsmb.shape[-1])
-    antdyn = antdyn.reshape(-1, antdyn.shape[-1])
-    greensmb = greensmb[:nsamps, :] * 1000.0  # Convert to mm
-    greendyn = greendyn[:nsamps, :] * 1000.0  # Convert to mm
-    antsmb = antsmb[:nsamps, :] * 1000.0  # Convert to mm
-    antdyn = antdyn[:nsamps, :] * 1000.0  # Convert to mm
+    data_years = data_years[targyear_idx]
 
     # If the user wants to extrapolate projections based on rates, do so here
     if cyear_start or cyear_end:
-        for i in np.arange(nsamps):
-            greendyn[i, :] = ExtrapolateRate(
-                greendyn[i, :], targyears, cyear_start, cyear_end
-            )
-            antdyn[i, :] = ExtrapolateRate(
-                antdyn[i, :], targyears, cyear_start, cyear_end
-            )
+        for component in (greendyn, antdyn):
+            ExtrapolateRate(component, targyears, cyear_start, cyear_end)
 
     # Sum up the components
     greennet = greendyn + greensmb
@@ -338,13 +497,12 @@ def ar5_project_icesheets(
         scenario=scenario,
         baseyear=startyr,
     )
-    gis_ds.to_netcdf(
-        path=global_gis_output_file,
-        mode="w",
-        format="NETCDF4",
-        encoding={
-            "sea_level_change": {"zlib": True, "complevel": 4}
-        },  # maybe don't need this
+    WriteOutput(
+        gis_ds,
+        global_gis_output_file,
+        output_format=output_format,
+        compression=compression,
+        packing=packing,
     )
     ais_ds = make_projection_ds(
         ice_source="AIS",
@@ -355,13 +513,12 @@ def ar5_project_icesheets(
         scenario=scenario,
         baseyear=startyr,
     )
-    ais_ds.to_netcdf(
-        path=global_ais_output_file,
-        mode="w",
-        format="NETCDF4",
-        encoding={
-            "sea_level_change": {"zlib": True, "complevel": 4}
-        },  # maybe don't need this
+    WriteOutput(
+        ais_ds,
+        global_ais_output_file,
+        output_format=output_format,
+        compression=compression,
+        packing=packing,
     )
     # Write the netCDF output
     # WriteNetCDF(greennet, "GIS", data_years, scenario, pipeline_id)
@@ -375,28 +532,15 @@ def ar5_project_icesheets(
     # Load in the icesheet fraction data-------------------------------------------
     # Note: These were derived from the Kopp14 workflow.
 
-    # Initialize the data structures
-    ice_frac = []
-    ice_region_names = []
-
-    # Open the icesheet fraction file
-    # ice_frac_file = os.path.join(os.path.dirname(__file__), "icesheet_fraction.txt")
-    with open(icesheet_fraction_file, "r", encoding="utf-8") as fp:
-        # Get the fraction years from the header line
-        header_items = re.split(",\s*", fp.readline())
-        ice_frac_years = np.array([int(x) for x in header_items[1:]])
-
-        # Read in the rest of the files
-        for line in fp:
-            line = line.rstrip()
-
-            # Split the line into the region name and the fractions then append to data structures
-            line_parts = re.split(",\s*", line)
-            ice_region_names.append(line_parts[0])
-            ice_frac.append([float(x) for x in line_parts[1:]])
-
-    # Convert the fraction data structure into a numpy array
-    ice_frac = np.array(ice_frac)
+    # Read the icesheet fraction file, or take the fractions from the input bundle
+    if icesheet_fraction_file is None and input_bundle is not None:
+        (ice_region_names, ice_frac_years, ice_frac) = BundleFractions(
+            input_bundle, "ice"
+        )
+    else:
+        (ice_region_names, ice_frac_years, ice_frac) = ReadFractionFile(
+            icesheet_fraction_file
+        )
 
     # Subset the fraction data to the years of interest
     year_idx = np.isin(ice_frac_years, data_years)
@@ -404,7 +548,7 @@ def ar5_project_icesheets(
 
     # Reshape the samples and fraction data structures for broadcasting
     antnet = antnet[:, np.newaxis, :]
-    ice_frac = ice_frac[np.newaxis, :, :]
+    ice_frac = ice_frac[np.newaxis, :, :].astype(antnet.dtype, copy=False)
 
     # Apply the regional fractions to the global projections
     aissamps = antnet * ice_frac
@@ -435,13 +579,12 @@ def ar5_project_icesheets(
         scenario=scenario,
         baseyear=startyr,
     )
-    wais_ds.to_netcdf(
-        path=global_wais_output_file,
-        mode="w",
-        format="NETCDF4",
-        encoding={
-            "sea_level_change": {"zlib": True, "complevel": 4}
-        },  # maybe don't need this
+    WriteOutput(
+        wais_ds,
+        global_wais_output_file,
+        output_format=output_format,
+        compression=compression,
+        packing=packing,
     )
     eais_ds = make_projection_ds(
         ice_source="EAIS",
@@ -452,13 +595,12 @@ def ar5_project_icesheets(
         scenario=scenario,
         baseyear=startyr,
     )
-    eais_ds.to_netcdf(
-        path=global_eais_output_file,
-        mode="w",
-        format="NETCDF4",
-        encoding={
-            "sea_level_change": {"zlib": True, "complevel": 4}
-        },  # maybe don't need this
+    WriteOutput(
+        eais_ds,
+        global_eais_output_file,
+        output_format=output_format,
+        compression=compression,
+        packing=packing,
     )
     # WriteNetCDF(aissamps[:, 0, :], "WAIS", data_years, scenario, pipeline_id)
     # WriteNetCDF(aissamps[:, 1, :], "EAIS", data_years, scenario, pipeline_id)
@@ -0,0 +1,128 @@
+import numpy as np
+
+from ipccar5 import filecache
+
+""" preprocess_cache.py
+
+Content-addressed on-disk cache of the arrays produced by the glaciers and ice sheets
+preprocess stages.
+
+Both stages import the same climate file and derive the same temperature anomalies,
+ensemble means and SDs and time integrals from it, so for equal settings they share
+one cache entry: the second command of a workflow, and every rerun, loads the arrays
+instead of recomputing them. Entries are keyed by the contents of the climate file,
+the scenario, the reference period, the first and last (exclusive) years and the
+precision of the sample arrays, and are
+stored as .npy files that are loaded memory-mapped (read-only). When the preprocess
+found repeated samples, the unique trajectories and sample map are stored instead of
+the sample arrays.
+
+The glaciers and ice sheets commands and ar5_run_all() read the climate data up to
+the same end year (see preprocess_end_year()), so that their preprocess settings,
+and cache keys, match.
+
+The entries are named with their own prefix, so the cache directory can be shared
+with the peak-temperature index, and are bounded in size: after each save the least
+recently used preprocess arrays are evicted until they take at most cache_max_bytes.
+
+"""
+
+# Arrays of the preprocess dictionary held in the cache
+PREPROCESS_ARRAYS = (
+    "temp_mean",
+    "temp_sd",
+    "inttemp_mean",
+    "inttemp_sd",
+    "data_years",
+)
+
+# Sample arrays of the preprocess dictionary held in the cache: the samples, or the
+# unique trajectories and the trajectory of each sample of ensembles with repeated
+# samples
+PREPROCESS_SAMPLE_ARRAYS = ("temp_samples", "inttemp_samples")
+PREPROCESS_UNIQUE_ARRAYS = ("temp_unique", "inttemp_unique", "sample_map")
+
+# Default size bound of the preprocess cache (4 GiB)
+CACHE_MAX_BYTES = 4 << 30
+
+# Prefix of the keys of the preprocess cache entries
+CACHE_PREFIX = "pre-"
+
+# Last year the climate data is always read to: the ice-sheet dynamics ranges are
+# defined in 2100
+PREPROCESS_MIN_END_YEAR = 2100
+
+
+def preprocess_key(
+    cache_dir,
+    climate_fname,
+    scenario,
+    refyear_start,
+    refyear_end,
+    start_year,
+    end_year,
+    precision="float64",
+):
+    # Key of the cache entry for these preprocess settings
+    return filecache.cache_key(
+        "preprocess-v1",
+        filecache.file_digest(climate_fname, cache_dir),
+        "surface_temperature",
+        scenario,
+        int(refyear_start),
+        int(refyear_end),
+        int(start_year),
+        int(end_year),
+        np.dtype(precision).str,
+    )
+
+
+def preprocess_end_year(pyear_end, end_year=None):
+    # First year (exclusive) of the climate data the preprocess reads: the years up
+    # to the end of the projection, and at least to PREPROCESS_MIN_END_YEAR, or up to
+    # end_year if that is earlier
+    endyr = max(pyear_end, PREPROCESS_MIN_END_YEAR) + 1
+    return endyr if end_year is None else min(end_year, endyr)
+
+
+def load_preprocess(cache_dir, key):
+    # Return the cached preprocess arrays in a dictionary, or None if any is missing
+    output = _load_arrays(cache_dir, key, PREPROCESS_ARRAYS)
+    if output is None:
+        return None
+
+    # The unique trajectories if the entry holds them, otherwise the samples
+    samples = _load_arrays(cache_dir, key, PREPROCESS_UNIQUE_ARRAYS)
+    if samples is None:
+        samples = _load_arrays(cache_dir, key, PREPROCESS_SAMPLE_ARRAYS)
+    if samples is None:
+        return None
+    output.update(samples)
+    return output
+
+
+def save_preprocess(cache_dir, key, output, cache_max_bytes=CACHE_MAX_BYTES):
+    # Store the preprocess arrays of a preprocess dictionary under key
+    for name in PREPROCESS_ARRAYS + PREPROCESS_SAMPLE_ARRAYS + PREPROCESS_UNIQUE_ARRAYS:
+        if name in output:
+            filecache.save_array(cache_dir, _entry_key(key, name), output[name])
+
+    # Keep the preprocess entries of the cache directory within their size bound
+    filecache.evict(cache_dir, cache_max_bytes, prefix=CACHE_PREFIX)
+
+
+def _load_arrays(cache_dir, key, names):
+    # Return the named arrays of the entry key in a dictionary, or None if any is
+    # missing
+    arrays = {}
+    for name in names:
+        arr = filecache.load_array(cache_dir, _entry_key(key, name), mmap_mode="r")
+        if arr is None:
+            return None
+        arrays[name] = arr
+    return arrays
+
+
+def _entry_key(key, name):
+    # Key of the cache file of one array of the entry key
+    return CACHE_PREFIX + filecache.cache_key(key, name)
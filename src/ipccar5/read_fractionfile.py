@@ -0,0 +1,46 @@
+import numpy as np
+import re
+
+""" read_fractionfile.py
+
+Reads in a regional fraction file (glacier_fraction.txt or icesheet_fraction.txt).
+The header line holds the fraction years, and every following line holds a region
+name and the fraction of the global contribution attributed to that region in each
+year, separated by commas.
+
+Parameters:
+fraction_file = Fraction file
+
+Return:
+region_names = List of region names
+frac_years = Vector of fraction years
+frac = Array of fractions [regions, years]
+
+"""
+
+
+def ReadFractionFile(fraction_file):
+    # Initialize the data structures
+    frac = []
+    region_names = []
+
+    # Open the fraction file
+    with open(fraction_file, "r", encoding="utf-8") as fp:
+        # Get the fraction years from the header line
+        header_items = re.split(r",\s*", fp.readline())
+        frac_years = np.array([int(x) for x in header_items[1:]])
+
+        # Read in the rest of the files
+        for line in fp:
+            line = line.rstrip()
+
+            # Split the line into the region name and the fractions then append to data structures
+            line_parts = re.split(r",\s*", line)
+            region_names.append(line_parts[0])
+            frac.append([float(x) for x in line_parts[1:]])
+
+    # Convert the fraction data structure into a numpy array
+    frac = np.array(frac)
+
+    # Return variables
+    return (region_names, frac_years, frac)
@@ -0,0 +1,168 @@
+import tempfile
+
+import numpy as np
+
+from ipccar5.Import2lmData import _climate_file, _year_rows
+
+""" stream_preprocess.py
+
+Streaming version of the temperature preprocessing shared by the glaciers and ice
+sheets workflows, for ensembles too large to hold in memory.
+
+The climate file is read in chunks of samples. Each chunk is referenced to the mean
+over the reference period, written to the on-disk sample arrays and integrated over
+time there, and folded into running per-year statistics with the pairwise update of
+Chan, Golub and LeVeque (Welford's one-pass algorithm applied to whole chunks), so
+the ensemble mean and standard deviation are numerically stable without a second
+pass. Peak memory is set by the chunk size rather than the ensemble size.
+
+The sample arrays are memory maps of temporary files, which are deleted once the
+arrays are no longer referenced. The project stages read them lazily.
+
+Only standard (non temperature target) scenarios are supported. As in
+Filter2lmData(), samples that are missing in every year are dropped, so the result
+is the same as that of the in-memory preprocess and shares its cache entry.
+
+Parameters:
+climate_fname = Climate data file (FAIR / two-layer model output)
+scenario = Scenario group to read
+refyear_start, refyear_end = Reference period (inclusive)
+start_year, end_year = First and last (exclusive) years to keep
+chunk_samples = Number of samples to read at a time
+tmp_dir = Directory for the temporary sample files (default: the system default)
+climate_format = Format of the climate data file (see climate_reader.py)
+dtype = Type of the sample arrays (default: the type of the climate data); the
+        statistics and time integrals are accumulated in double precision
+
+Return:
+Dictionary with temp_mean, temp_sd, inttemp_mean, inttemp_sd, data_years,
+temp_samples and inttemp_samples, as produced by the preprocess functions
+
+"""
+
+
+def StreamPreprocess(
+    climate_fname,
+    scenario,
+    refyear_start,
+    refyear_end,
+    start_year,
+    end_year,
+    chunk_samples=10000,
+    tmp_dir=None,
+    climate_format="auto",
+    dtype=None,
+):
+    if scenario.startswith("tlim"):
+        raise ValueError(
+            "Streaming preprocess does not support temperature target scenarios: {0}".format(
+                scenario
+            )
+        )
+
+    # Use the climate file if it is kept open, otherwise open it for this call
+    (hf, keep_open) = _climate_file(climate_fname, climate_format)
+    try:
+        dset = hf[scenario]["surface_temperature"]
+    except KeyError as e:
+        raise ValueError(
+            "Exception: {}. Cannot extract data for this combination: {} - {}".format(
+                e, scenario, "surface_temperature"
+            )
+        )
+
+    # Rows of the reference period and of the years to keep
+    years = np.arange(1750, 1750 + dset.shape[0])
+    ref_rows = _year_rows(years, refyear_start, refyear_end)
+    rows = _year_rows(years, start_year, end_year - 1)
+    data_years = years[rows]
+    (nyears, nsamps) = (len(data_years), dset.shape[1])
+
+    # On-disk sample arrays [samples, years]
+    if dtype is None:
+        dtype = dset.dtype
+    temp_samples = _temporary_array((nsamps, nyears), dtype, tmp_dir)
+    inttemp_samples = _temporary_array((nsamps, nyears), dtype, tmp_dir)
+
+    # Number of samples kept so far
+    nkept = 0
+
+    # Running count, mean and sum of squared deviations of each year
+    count = np.zeros(nyears)
+    mean = np.zeros(nyears)
+    m2 = np.zeros(nyears)
+
+    for c0 in range(0, nsamps, chunk_samples):
+        c1 = min(c0 + chunk_samples, nsamps)
+
+        # Read this chunk of samples and reference it to the reference period
+        ref_vals = np.mean(dset[ref_rows, c0:c1], axis=0)
+        chunk = dset[rows, c0:c1].T - ref_vals[:, np.newaxis]
+        chunk = chunk.astype(dtype, copy=False)
+
+        # Drop the samples that are missing in every year
+        chunk = chunk[~np.all(np.isnan(chunk), axis=1)]
+        (k0, nkept) = (nkept, nkept + chunk.shape[0])
+
+        # Write the samples and their time integral
+        temp_samples[k0:nkept] = chunk
+        inttemp_samples[k0:nkept] = np.cumsum(chunk, axis=1, dtype=np.float64)
+
+        # Statistics of this chunk, ignoring missing values
+        valid = ~np.isnan(chunk)
+        chunk_count = np.sum(valid, axis=0)
+        chunk_sum = np.sum(np.where(valid, chunk, 0.0), axis=0, dtype=np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            chunk_mean = np.where(chunk_count > 0, chunk_sum / chunk_count, 0.0)
+        chunk_m2 = np.sum(
+            np.where(valid, chunk - chunk_mean, 0.0) ** 2, axis=0, dtype=np.float64
+        )
+
+        # Combine them with the running statistics
+        total = count + chunk_count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = chunk_mean - mean
+            mean = np.where(total > 0, mean + delta * chunk_count / total, 0.0)
+            m2 = np.where(
+                total > 0, m2 + chunk_m2 + delta**2 * count * chunk_count / total, 0.0
+            )
+        count = total
+
+    for arr in (temp_samples, inttemp_samples):
+        arr.flush()
+
+    if not keep_open:
+        hf.close()
+
+    # Fail if no samples are left, as Filter2lmData()
+    if nkept == 0:
+        raise ValueError(
+            "Cannot find samples with data for this combination: {} - {}".format(
+                scenario, "surface_temperature"
+            )
+        )
+
+    # Mean and SD of the ensemble (population SD, as np.nanstd)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        temp_mean = np.where(count > 0, mean, np.nan)
+        temp_sd = np.where(count > 0, np.sqrt(m2 / count), np.nan)
+
+    # Integrate temperature to obtain K yr at ends of calendar years, replicating the
+    # cumulative sum of the standard deviations of the in-memory preprocess
+    output = {
+        "temp_mean": temp_mean,
+        "temp_sd": temp_sd,
+        "inttemp_mean": np.cumsum(temp_mean),
+        "inttemp_sd": np.cumsum(temp_sd),
+        "data_years": data_years,
+        "temp_samples": temp_samples[:nkept],
+        "inttemp_samples": inttemp_samples[:nkept],
+    }
+
+    return output
+
+
+def _temporary_array(shape, dtype, tmp_dir=None):
+    # Memory-mapped array backed by an anonymous temporary file
+    f = tempfile.TemporaryFile(dir=tmp_dir)
+    return np.memmap(f, dtype=dtype, mode="w+", shape=shape)
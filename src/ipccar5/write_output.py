@@ -0,0 +1,577 @@
+import contextlib
+import logging
+import os
+import threading
+
+import numpy as np
+import netCDF4
+import numcodecs
+import dask
+import dask.array as da
+import xarray as xr
+from xarray.backends.common import ArrayWriter
+from xarray.backends.locks import HDF5_LOCK, NETCDFC_LOCK, combine_locks, get_write_lock
+
+""" write_output.py
+
+Writes the global and local sea-level datasets of the workflows to NetCDF files or
+Zarr stores, compressed according to a shared compression policy.
+
+Every writer of the workflows describes the type and fill value of its variables
+with an encoding in NetCDF terms (dtype, _FillValue); how they are compressed is set
+by the compression policy, and WriteOutput translates both for the chosen format:
+
+netcdf = A NETCDF4 file written through the netCDF4 library
+zarr = A Zarr store (directory, Zarr format 2 with consolidated metadata, which
+       xarray and older zarr readers open directly), chunked as the dataset's dask
+       arrays (or, for numpy arrays, by zarr's default chunking). Blosc compresses
+       with several threads, and the chunks of dask arrays are compressed and written
+       in parallel instead of through the single netCDF lock.
+
+A compression policy (see CompressionPolicy()) is a dictionary with
+codec = One of COMPRESSION_CODECS, or None for the default of the output format:
+        zlib for NetCDF and Blosc/Zstd for Zarr. The NetCDF codecs are those of
+        netCDF4 1.7; zstd, bzip2 and the blosc codecs need their HDF5 filter
+        plugins, which not every netCDF4 build provides (see CodecAvailable()).
+        For Zarr the same codecs are taken from numcodecs.
+level = Compression level
+shuffle = Whether to apply the byte-shuffle filter before compressing (the blosc
+          codecs shuffle internally instead)
+variables = Names of the variables to compress
+levels = Optional compression levels of single variables, by name; these variables
+         are compressed as well
+
+The default policy (zlib level 4 with the shuffle filter for NetCDF) is the
+compression the outputs have always been written with.
+
+A packing policy (see PackingPolicy()) optionally reduces the precision of variables
+before they are compressed, and is a dictionary with
+dtype = One of PACKING_TYPES to store the variables as integers with scale_factor
+        and add_offset (CF packing, decoded transparently by xarray and netCDF4), or
+        None to keep their floating point type
+resolution = Largest step between packed values (in the units of the variables);
+             the step is widened, with a warning, when the valid range of a
+             variable does not fit the integer type at this resolution
+keepbits = Optional number of mantissa bits to keep by bit-rounding variables that
+           are not packed (netCDF4 BitRound quantization, or numcodecs BitRound for
+           Zarr), which makes them compress better
+variables = Names of the variables to pack
+
+The scale_factor and add_offset of packed variables are set from their valid ranges
+(see PackingRanges()), which are recorded in the actual_range attribute, and the
+step between packed values in the packing_resolution attribute. Missing
+values are stored as the smallest value of the integer type.
+
+A chunk policy (see ChunkPolicy()) sets the chunk shape of the local outputs, laid
+out as (samples, years, locations), and is a dictionary with
+layout = One of CHUNK_LAYOUTS, or None for the default chunking of the format:
+         location = One chunk per location, holding all its samples and years, so
+                    reading the full block of one site decompresses that chunk alone
+         sample = Chunks of all years for as many samples as fit in chunk_bytes,
+                  and the locations of one dask block of the writer, for reading
+                  a few samples at many locations
+chunks = Optional chunk sizes of single dimensions, by name, overriding the layout
+         (-1 for the whole dimension)
+chunk_bytes = Target size of the chunks of the sample layout (uncompressed)
+cache_bytes = Optional size of the HDF5 chunk cache of the NetCDF variables being
+              written (default, with a layout or chunks: large enough for the chunks
+              of one dask block of the writer)
+variables = Names of the variables to chunk
+
+Both layouts split the locations at the boundaries of the writer's dask blocks, so
+every chunk is written whole from a single block and is compressed once. The chunk
+cache is set through netCDF4.set_chunk_cache() while the variables are defined and
+restored afterwards. The setting is process-wide, so NetCDF outputs are set up one
+at a time under a lock, which every chunk write of a NetCDF output also takes; the
+writes themselves run outside the setup, with compute=False when the returned
+Delayed objects are computed (together, with ComputeWrites()). Explicit chunk sizes that cut across the dask blocks of a Zarr output are rechunked to match.
+
+Parameters:
+ds = Dataset to write
+path = Output file (NetCDF) or store (Zarr)
+encoding = Encoding of the variables, in NetCDF terms
+output_format = "netcdf" or "zarr"
+compute = Write now (True) or return a dask Delayed that writes when computed (False)
+compression = Compression policy (default: CompressionPolicy())
+packing = Optional packing policy (default: no packing)
+packing_ranges = Optional valid ranges of the packed variables, as returned by
+                 PackingRanges() (default: computed from ds)
+chunking = Optional chunk policy (default: the default chunking of the format)
+
+"""
+
+# Output formats by name
+OUTPUT_FORMATS = ("netcdf", "zarr")
+
+# Compression codecs by name, as named by netCDF4
+COMPRESSION_CODECS = (
+    "none",
+    "zlib",
+    "zstd",
+    "bzip2",
+    "blosc_lz",
+    "blosc_lz4",
+    "blosc_lz4hc",
+    "blosc_zlib",
+    "blosc_zstd",
+)
+
+# Variables compressed by default
+COMPRESSED_VARIABLES = ("sea_level_change",)
+
+# Blosc compressor names of the blosc codecs
+_BLOSC_CNAMES = {
+    "blosc_lz": "blosclz",
+    "blosc_lz4": "lz4",
+    "blosc_lz4hc": "lz4hc",
+    "blosc_zlib": "zlib",
+    "blosc_zstd": "zstd",
+}
+
+# netCDF4 Dataset methods reporting whether the filter of a codec is available
+_NETCDF_FILTERS = {
+    "zstd": "has_zstd_filter",
+    "bzip2": "has_bzip2_filter",
+    **{codec: "has_blosc_filter" for codec in _BLOSC_CNAMES},
+}
+
+# Availability of the NetCDF filters, as found by CodecAvailable()
+_netcdf_filters_available = {}
+
+# Integer types of packed variables by name
+PACKING_TYPES = ("int16", "int32")
+
+# Chunk layouts of the local outputs by name
+CHUNK_LAYOUTS = ("location", "sample")
+
+# Dimensions of the local outputs
+_LOCAL_DIMS = ("samples", "years", "locations")
+
+logger = logging.getLogger(__name__)
+
+# Serializes the setup of the NetCDF outputs of concurrent writers against each other
+# and against their chunk writes. The chunk cache set for one output is process-wide,
+# and xarray defines variables and syncs a new file outside its HDF5 lock, which
+# corrupts the HDF5 state when another thread is writing. The lock is added to the
+# store lock of every NetCDF output, and is reentrant so that the setup can take it.
+_NETCDF_WRITE_LOCK = threading.RLock()
+
+
+def CompressionPolicy(
+    codec=None, level=4, shuffle=True, variables=COMPRESSED_VARIABLES, levels=None
+):
+    # Build a compression policy, checking the codec name
+    if codec is not None and codec not in COMPRESSION_CODECS:
+        raise ValueError(
+            "Unknown compression codec {0}, expected one of {1}".format(
+                codec, ", ".join(COMPRESSION_CODECS)
+            )
+        )
+    return {
+        "codec": codec,
+        "level": int(level),
+        "shuffle": bool(shuffle),
+        "variables": tuple(variables),
+        "levels": dict(levels or {}),
+    }
+
+
+def PackingPolicy(
+    dtype=None, resolution=0.1, keepbits=None, variables=COMPRESSED_VARIABLES
+):
+    # Build a packing policy, checking the type and number of bits
+    if dtype is not None and dtype not in PACKING_TYPES:
+        raise ValueError(
+            "Unknown packing type {0}, expected one of {1}".format(
+                dtype, ", ".join(PACKING_TYPES)
+            )
+        )
+    if not resolution > 0:
+        raise ValueError(
+            "Packing resolution must be positive, got {0}".format(resolution)
+        )
+    if keepbits is not None:
+        if dtype is not None:
+            raise ValueError("Bit-rounding applies to variables that are not packed")
+        if not 0 <= keepbits <= 23:
+            raise ValueError(
+                "Bit-rounding keeps 0 to 23 mantissa bits, got {0}".format(keepbits)
+            )
+    return {
+        "dtype": dtype,
+        "resolution": float(resolution),
+        "keepbits": None if keepbits is None else int(keepbits),
+        "variables": tuple(variables),
+    }
+
+
+def PackingRanges(datasets, packing):
+    # Valid (minimum, maximum) of the packed variables of several datasets, by name
+    # for each dataset. The ranges of dask arrays are reduced chunk by chunk in one
+    # computation for all datasets, so datasets built from shared dask arrays compute
+    # their chunks once.
+    names = []
+    reductions = []
+    for ds in datasets:
+        if packing is None or packing["dtype"] is None:
+            names.append([])
+            continue
+        names.append([name for name in packing["variables"] if name in ds.variables])
+        for name in names[-1]:
+            x = da.asarray(ds[name].data)
+            reductions.extend([da.nanmin(x), da.nanmax(x)])
+    with np.errstate(invalid="ignore"):
+        values = iter(dask.compute(*reductions))
+    return [{name: (next(values), next(values)) for name in x} for x in names]
+
+
+def ChunkPolicy(
+    layout=None,
+    chunks=None,
+    chunk_bytes=2**20,
+    cache_bytes=None,
+    variables=COMPRESSED_VARIABLES,
+):
+    # Build a chunk policy, checking the layout and sizes
+    if layout is not None and layout not in CHUNK_LAYOUTS:
+        raise ValueError(
+            "Unknown chunk layout {0}, expected one of {1}".format(
+                layout, ", ".join(CHUNK_LAYOUTS)
+            )
+        )
+    chunks = dict(chunks or {})
+    for dim, size in chunks.items():
+        if size != -1 and not size >= 1:
+            raise ValueError(
+                "Chunk size of {0} must be positive or -1, got {1}".format(dim, size)
+            )
+    return {
+        "layout": layout,
+        "chunks": {dim: int(size) for dim, size in chunks.items()},
+        "chunk_bytes": int(chunk_bytes),
+        "cache_bytes": None if cache_bytes is None else int(cache_bytes),
+        "variables": tuple(variables),
+    }
+
+
+def CodecAvailable(codec, output_format="netcdf"):
+    # Whether a compression codec can be written in an output format
+    if output_format != "netcdf" or codec not in _NETCDF_FILTERS:
+        return True
+    if codec not in _netcdf_filters_available:
+        # Ask the netCDF-C library whether the filter plugin can be loaded; builds
+        # may be compiled with a codec but ship without its HDF5 plugin
+        ds = netCDF4.Dataset("filter_probe.nc", "w", diskless=True, persist=False)
+        try:
+            _netcdf_filters_available[codec] = bool(
+                getattr(ds, _NETCDF_FILTERS[codec])()
+            )
+        finally:
+            ds.close()
+    return _netcdf_filters_available[codec]
+
+
+def WriteOutput(
+    ds,
+    path,
+    encoding=None,
+    output_format="netcdf",
+    compute=True,
+    compression=None,
+    packing=None,
+    packing_ranges=None,
+    chunking=None,
+):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            "Unknown output format {0}, expected one of {1}".format(
+                output_format, ", ".join(OUTPUT_FORMATS)
+            )
+        )
+    if compression is None:
+        compression = CompressionPolicy()
+    if compression["codec"] is not None and not CodecAvailable(
+        compression["codec"], output_format
+    ):
+        raise ValueError(
+            "Compression codec {0} is not available in this netCDF4 build".format(
+                compression["codec"]
+            )
+        )
+
+    encoding = {name: dict(x) for name, x in (encoding or {}).items()}
+
+    # Pack the packed variables to integers, or bit-round them
+    if packing is not None:
+        if packing["dtype"] is not None and packing_ranges is None:
+            (packing_ranges,) = PackingRanges([ds], packing)
+        ds = ds.copy()
+        for name in packing["variables"]:
+            if name not in ds.variables:
+                continue
+            var_encoding = encoding.setdefault(name, {})
+            if packing["dtype"] is not None:
+                var_encoding.update(
+                    _packed_encoding(
+                        packing,
+                        packing_ranges[name],
+                        np.dtype(var_encoding.get("dtype", ds[name].dtype)),
+                    )
+                )
+                # The missing value is now the fill value of the integer type
+                ds[name].attrs = {
+                    k: v for (k, v) in ds[name].attrs.items() if k != "missing_value"
+                }
+                ds[name].attrs["actual_range"] = np.array(
+                    packing_ranges[name], dtype=var_encoding["scale_factor"].dtype
+                )
+                ds[name].attrs["packing_resolution"] = var_encoding["scale_factor"]
+                if var_encoding["scale_factor"] > packing["resolution"]:
+                    logger.warning(
+                        "%s in %s is packed to %s with a resolution of %g instead "
+                        "of %g, to fit its range [%g, %g]; pack it to a wider type "
+                        "to keep the requested resolution",
+                        name,
+                        path,
+                        packing["dtype"],
+                        var_encoding["scale_factor"],
+                        packing["resolution"],
+                        *packing_ranges[name],
+                    )
+                var_encoding["missing_value"] = var_encoding["_FillValue"]
+            elif packing["keepbits"] is not None and output_format == "netcdf":
+                var_encoding["significant_digits"] = packing["keepbits"]
+                var_encoding["quantize_mode"] = "BitRound"
+
+    # Set the chunk shape of the chunked variables, and the chunk cache they need
+    cache_bytes = None
+    if chunking is not None:
+        cache_bytes = chunking["cache_bytes"]
+        for name in chunking["variables"]:
+            if name not in ds.variables:
+                continue
+            var_encoding = encoding.setdefault(name, {})
+            itemsize = np.dtype(var_encoding.get("dtype", ds[name].dtype)).itemsize
+            chunks = _chunk_shape(chunking, ds[name], itemsize)
+            if chunks is None:
+                continue
+            if output_format == "netcdf":
+                var_encoding["chunksizes"] = chunks
+                var_encoding["contiguous"] = False
+            else:
+                # Zarr chunks written in parallel must not span dask blocks, so
+                # explicit chunk sizes that cut across them are rechunked to match
+                var_encoding["chunks"] = chunks
+                if not _blocks_aligned(ds[name], chunks):
+                    ds = ds.copy()
+                    ds[name] = ds[name].chunk(dict(zip(ds[name].dims, chunks)))
+            if chunking["cache_bytes"] is None:
+                cache_bytes = max(
+                    cache_bytes or 0, _block_cache_bytes(ds[name], chunks, itemsize)
+                )
+
+    # Add the compression of each compressed variable to its encoding
+    for name in list(compression["variables"]) + list(compression["levels"]):
+        if name not in ds.variables:
+            continue
+        level = compression["levels"].get(name, compression["level"])
+        var_encoding = encoding.setdefault(name, {})
+        if output_format == "netcdf":
+            var_encoding.update(_netcdf_compression(compression, level))
+        else:
+            itemsize = np.dtype(var_encoding.get("dtype", ds[name].dtype)).itemsize
+            var_encoding.update(_zarr_compression(compression, level, itemsize))
+
+    # Bit-round Zarr variables ahead of the other filters
+    if packing is not None and packing["dtype"] is None and output_format == "zarr":
+        for name in packing["variables"]:
+            if name in ds.variables and packing["keepbits"] is not None:
+                var_encoding = encoding.setdefault(name, {})
+                var_encoding["filters"] = [
+                    numcodecs.BitRound(keepbits=packing["keepbits"])
+                ] + list(var_encoding.get("filters") or [])
+
+    if output_format == "netcdf":
+        write = _setup_netcdf(ds, path, encoding, cache_bytes)
+        return write.compute() if compute else write
+    return ds.to_zarr(
+        path,
+        mode="w",
+        encoding=encoding,
+        compute=compute,
+        zarr_format=2,
+        consolidated=True,
+    )
+
+
+def ComputeWrites(writes, output_format="netcdf"):
+    # Compute the Delayed writes returned by WriteOutput(compute=False) together (the
+    # chunk writes of NetCDF outputs take the NetCDF write lock one at a time)
+    return dask.compute(*writes)
+
+
+def _setup_netcdf(ds, path, encoding, cache_bytes):
+    # Create a NetCDF file and its variables under the NetCDF write lock, as
+    # Dataset.to_netcdf(compute=False) does, and return a Delayed that writes the
+    # dask arrays and closes the file. The store lock adds the NetCDF write lock to
+    # xarray's own, so that no chunk is written while another output is set up.
+    path = os.fspath(path)
+    lock = combine_locks(
+        [_NETCDF_WRITE_LOCK, NETCDFC_LOCK, HDF5_LOCK, get_write_lock(path)]
+    )
+    with _chunk_cache(cache_bytes):
+        store = xr.backends.NetCDF4DataStore.open(
+            path, mode="w", format="NETCDF4", lock=lock
+        )
+        try:
+            writer = ArrayWriter()
+            ds.dump_to_store(store, writer=writer, encoding=encoding)
+            writes = writer.sync(compute=False)
+            store.sync()
+        except BaseException:
+            store.close()
+            raise
+    return dask.delayed(_close_after_writes)(writes, store)
+
+
+def _close_after_writes(writes, store):
+    # Close a NetCDF store once its chunks are written
+    del writes
+    store.close()
+
+
+def _chunk_shape(chunking, var, itemsize):
+    # Chunk shape of a variable under a chunk policy, or None to keep the default
+    if chunking["layout"] is None and not chunking["chunks"]:
+        return None
+    if chunking["layout"] is not None and set(var.dims) != set(_LOCAL_DIMS):
+        return None
+    sizes = dict(zip(var.dims, var.shape))
+
+    # Locations of the writer's first dask block (all of them for numpy arrays)
+    blocks = dict(zip(var.dims, var.chunks or var.shape))
+    if chunking["layout"] == "location":
+        chunks = {"samples": sizes["samples"], "years": sizes["years"], "locations": 1}
+    elif chunking["layout"] == "sample":
+        locations = blocks["locations"]
+        locations = locations[0] if isinstance(locations, tuple) else locations
+        row_bytes = sizes["years"] * locations * itemsize
+
+        # Split the samples evenly into as few chunks as keep within chunk_bytes
+        nchunks = -(-sizes["samples"] * row_bytes // chunking["chunk_bytes"])
+        chunks = {
+            "samples": -(-sizes["samples"] // max(1, nchunks)),
+            "years": sizes["years"],
+            "locations": locations,
+        }
+    else:
+        chunks = dict(sizes)
+
+    # Explicit sizes override the layout
+    for dim, size in chunking["chunks"].items():
+        if dim in sizes:
+            chunks[dim] = sizes[dim] if size == -1 else size
+    return tuple(max(1, min(chunks[dim], sizes[dim])) for dim in var.dims)
+
+
+def _block_cache_bytes(var, chunks, itemsize):
+    # Chunk cache holding all chunks that one dask block of a variable touches,
+    # and at least the default cache of netCDF4
+    block = [x[0] if isinstance(x, tuple) else x for x in (var.chunks or var.shape)]
+    nchunks = np.prod([-(-b // c) for (b, c) in zip(block, chunks)])
+    return max(int(nchunks * np.prod(chunks) * itemsize), netCDF4.get_chunk_cache()[0])
+
+
+def _blocks_aligned(var, chunks):
+    # Whether every dask block of a variable holds whole chunks (all but the last
+    # block along each dimension are multiples of the chunk size)
+    if var.chunks is None:
+        return True
+    return all(
+        all(b % c == 0 for b in blocks[:-1]) for (blocks, c) in zip(var.chunks, chunks)
+    )
+
+
+@contextlib.contextmanager
+def _chunk_cache(cache_bytes):
+    # Set the size of the HDF5 chunk cache of the variables defined in this context.
+    # The cache size is process-wide and taken by each variable when it is defined,
+    # so all NetCDF outputs are set up under the lock, with the cache set or not.
+    with _NETCDF_WRITE_LOCK:
+        if cache_bytes is None:
+            yield
+            return
+        (size, nelems, preemption) = netCDF4.get_chunk_cache()
+        netCDF4.set_chunk_cache(int(cache_bytes), nelems, preemption)
+        try:
+            yield
+        finally:
+            netCDF4.set_chunk_cache(size, nelems, preemption)
+
+
+def _packed_encoding(packing, valid_range, dtype):
+    # Integer type, fill value, scale_factor and add_offset of a packed variable,
+    # with the scale and offset in the floating point type of the variable
+    itype = np.dtype(packing["dtype"])
+    ftype = dtype if dtype.kind == "f" else np.dtype(np.float64)
+    (vmin, vmax) = valid_range
+
+    # Center the valid range on zero, leaving the smallest integer as fill value
+    # and a step of rounding margin at either end
+    nsteps = 2 * (np.iinfo(itype).max - 1)
+    if np.isfinite(vmin) and np.isfinite(vmax):
+        offset = (vmin + vmax) / 2.0
+        scale = max(packing["resolution"], (vmax - vmin) / nsteps)
+    else:
+        (offset, scale) = (0.0, packing["resolution"])
+
+    return {
+        "dtype": itype,
+        "_FillValue": np.iinfo(itype).min,
+        "scale_factor": ftype.type(scale),
+        "add_offset": ftype.type(offset),
+    }
+
+
+def _netcdf_compression(compression, level):
+    # netCDF4 encoding of a compressed variable
+    codec = compression["codec"] or "zlib"
+    if codec == "none":
+        return {"zlib": False}
+    if codec == "zlib":
+        return {"zlib": True, "complevel": level, "shuffle": compression["shuffle"]}
+    if codec in _BLOSC_CNAMES:
+        return {
+            "compression": codec,
+            "complevel": level,
+            "shuffle": False,
+            "blosc_shuffle": 1 if compression["shuffle"] else 0,
+        }
+    return {"compression": codec, "complevel": level, "shuffle": compression["shuffle"]}
+
+
+def _zarr_compression(compression, level, itemsize):
+    # Zarr (numcodecs) encoding of a compressed variable
+    codec = compression["codec"] or "blosc_zstd"
+    shuffle = compression["shuffle"]
+    if codec == "none":
+        return {"compressors": None}
+    if codec in _BLOSC_CNAMES:
+        return {
+            "compressors": [
+                numcodecs.Blosc(
+                    cname=_BLOSC_CNAMES[codec],
+                    clevel=level,
+                    shuffle=numcodecs.Blosc.SHUFFLE
+                    if shuffle
+                    else numcodecs.Blosc.NOSHUFFLE,
+                )
+            ]
+        }
+    compressor = {
+        "zlib": numcodecs.Zlib,
+        "zstd": numcodecs.Zstd,
+        "bzip2": numcodecs.BZ2,
+    }[codec](level=level)
+    filters = [numcodecs.Shuffle(elementsize=itemsize)] if shuffle else None
+    return {"compressors": [compressor], "filters": filters}